@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Digit Loader
+# Load digit_data.txt into NumPy arrays for the digit apps.
+# Each line holds a digit, a colon, a space, and the grid's 0s and 1s
+# in the format '6: 011110110000100000111111110001110001010001001111'
+
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+# Default grid size.
+NUM_ROWS = 8
+NUM_COLS = 6
+
+# Number of bytes to read and parse at a time.
+READ_CHUNK_BYTES = 1 << 24
+
+# Offset of the first 0 or 1 on each line.
+FIRST_CELL = 3
+
+# Version of the binary cache format. Caches with another version are rebuilt.
+CACHE_VERSION = 2
+
+# Version of the saved model format. Models with another version are retrained.
+MODEL_VERSION = 1
+
+# Labelled drawings are appended to a binary log next to the data file.
+# The log starts with LOG_MAGIC, LOG_VERSION, and the grid's rows and
+# columns as 2-byte little-endian numbers. Each record after that holds
+# the digit's name as one ASCII byte followed by its cells packed 8 per byte.
+LOG_MAGIC = b'DLOG'
+LOG_VERSION = 1
+LOG_HEADER_BYTES = len(LOG_MAGIC) + 5
+
+# When shrinking IDX images to the grid, a cell is 1 if the average
+# brightness of its pixels is at least this fraction of full brightness.
+IDX_THRESHOLD = 0.15
+
+# Number of IDX images to shrink at a time.
+IDX_CHUNK_IMAGES = 10000
+
+
+# The loaded data.
+#     features:  A uint8 array with one row of 0s and 1s per digit.
+#     labels:    An array holding each digit's name as a one-character string.
+#     source_hash: The SHA-256 hash of the file the data came from (or None).
+class DigitDataset:
+    def __init__(self, features, labels, num_rows=NUM_ROWS, num_cols=NUM_COLS, source_hash=None):
+        self.features = features
+        self.labels = labels
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.features)
+
+    # Return row i in the digit_data.txt format.
+    def data_string(self, i):
+        return f'{self.labels[i]}: {(self.features[i] + ord("0")).tobytes().decode()}'
+
+    # Return a sequence of DataPoints, one per row. Each DataPoint
+    # is made by calling make_data_point with the row's data string
+    # the first time it is used.
+    def data_points(self, make_data_point):
+        return LazyDataPoints(self, make_data_point)
+
+    # Add a row to the end of the data. This copies the arrays,
+    # so it is meant for adding a few rows at a time.
+    def append(self, features, label):
+        self.features = np.concatenate((self.features, np.asarray(features, dtype=np.uint8)[None, :]))
+        self.labels = np.concatenate((self.labels, np.array([label], dtype=self.labels.dtype)))
+        self.source_hash = None
+
+
+# A read-only sequence of DataPoints that are made as they are needed.
+class LazyDataPoints:
+    def __init__(self, dataset, make_data_point):
+        self.dataset = dataset
+        self.make_data_point = make_data_point
+        self.cache = [None] * len(dataset)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if self.cache[i] is None:
+            self.cache[i] = self.make_data_point(self.dataset.data_string(i))
+        return self.cache[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # Add a DataPoint for a row that was just appended to the dataset.
+    def append(self, data_point):
+        self.cache.append(data_point)
+
+
+# Parse a block of complete lines.
+# Return a features array and a labels array.
+def parse_lines(data, num_cells):
+    # Find the lines.
+    ends = np.flatnonzero(data == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+
+    # Skip blank lines.
+    lengths_without_cr = lengths - (data[np.maximum(ends - 1, 0)] == ord('\r'))
+    keep = lengths_without_cr > 0
+    starts = starts[keep]
+    lengths = lengths_without_cr[keep]
+
+    # Reject lines that do not fit the grid, including lines
+    # that are too long because the grid is too small.
+    if np.any(lengths != FIRST_CELL + num_cells):
+        raise ValueError(f'Each line must hold a digit and {num_cells} 0s and 1s')
+
+    # Gather the label byte and cell bytes of every line at once.
+    labels = data[starts].view('S1').astype('U1')
+    features = data[starts[:, None] + FIRST_CELL + np.arange(num_cells)] - ord('0')
+    if features.size > 0 and features.max() > 1:
+        raise ValueError('Each cell must be a 0 or 1')
+    return features.astype(np.uint8), labels
+
+# Return the SHA-256 hash of a file as a hex string.
+def file_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK_BYTES)
+            if not chunk: break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+# Return the directory that holds the binary cache for a data file.
+def cache_directory(path):
+    return path + '.cache'
+
+# Load a file in the digit_data.txt format.
+# The first time a file is loaded, the parsed arrays are saved as .npy
+# files in a cache directory next to it. Later loads memory-map those
+# files read-only, so they are almost instant and every process shares
+# the same pages. The cache is rebuilt when the file's size or hash changes.
+def load_digits(path='digit_data.txt', num_rows=NUM_ROWS, num_cols=NUM_COLS, use_cache=True):
+    if not use_cache:
+        return parse_digits(path, num_rows, num_cols)
+
+    dataset = load_cache(path, num_rows, num_cols)
+    if dataset is None:
+        dataset = parse_digits(path, num_rows, num_cols)
+        dataset.source_hash = file_hash(path)
+        try:
+            save_cache(path, dataset)
+        except OSError:
+            # We can still use the data if the cache cannot be written.
+            pass
+    return dataset
+
+# Load the cached arrays for a data file.
+# Return None if there is no cache or it does not match the file.
+def load_cache(path, num_rows, num_cols):
+    directory = cache_directory(path)
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != CACHE_VERSION or \
+        meta.get('num_rows') != num_rows or meta.get('num_cols') != num_cols:
+        return None
+
+    # Check the size first because it is cheap. If the modification time
+    # has changed, make sure the contents really are the same.
+    stat = os.stat(path)
+    if meta.get('size') != stat.st_size:
+        return None
+    if meta.get('mtime_ns') != stat.st_mtime_ns:
+        if meta.get('sha256') != file_hash(path):
+            return None
+
+        # Same contents. Save the new time so we can skip the hash next time.
+        meta['mtime_ns'] = stat.st_mtime_ns
+        try:
+            save_meta(directory, meta)
+        except OSError:
+            pass
+
+    try:
+        features = np.load(os.path.join(directory, 'features.npy'), mmap_mode='r')
+        labels = np.load(os.path.join(directory, 'labels.npy'), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return DigitDataset(features, labels, num_rows, num_cols, meta['sha256'])
+
+# Save a dataset's arrays in the cache directory for its data file.
+# meta.json is written last, so a half-written cache is never used.
+def save_cache(path, dataset):
+    directory = cache_directory(path)
+    save_arrays(directory, {'features': dataset.features, 'labels': dataset.labels})
+
+    stat = os.stat(path)
+    meta = {
+        'version': CACHE_VERSION,
+        'num_rows': dataset.num_rows,
+        'num_cols': dataset.num_cols,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': dataset.source_hash,
+    }
+    save_meta(directory, meta)
+
+# Save each array in a dictionary as a .npy file in the directory.
+def save_arrays(directory, arrays):
+    os.makedirs(directory, exist_ok=True)
+    for name, array in arrays.items():
+        replace_file(os.path.join(directory, name + '.npy'), 'wb',
+            lambda f: np.save(f, np.ascontiguousarray(array)))
+
+# Save a cache directory's meta.json file.
+def save_meta(directory, meta):
+    replace_file(os.path.join(directory, 'meta.json'), 'w', lambda f: json.dump(meta, f))
+
+# Write a file by calling write with a new temporary file in the same
+# directory and then renaming it into place. Each call gets its own
+# temporary file, so processes saving at the same time cannot write
+# into each other's files.
+def replace_file(path, mode, write):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+# Parse a file in the digit_data.txt format.
+# It is read and parsed in chunks of READ_CHUNK_BYTES bytes,
+# so the memory used is about the size of the finished arrays.
+def parse_digits(path='digit_data.txt', num_rows=NUM_ROWS, num_cols=NUM_COLS):
+    num_cells = num_rows * num_cols
+    feature_blocks = []
+    label_blocks = []
+    with open(path, 'rb') as f:
+        leftover = b''
+        while True:
+            chunk = f.read(READ_CHUNK_BYTES)
+            if not chunk:
+                # Make sure the last line has a newline.
+                if leftover:
+                    chunk = b'\n'
+                else:
+                    break
+
+            # Parse the complete lines and keep the rest for next time.
+            data = np.frombuffer(leftover + chunk, dtype=np.uint8)
+            last_newline = data.size - 1 - np.argmax(data[::-1] == ord('\n'))
+            if data[last_newline] != ord('\n'):
+                leftover = data.tobytes()
+                continue
+            leftover = data[last_newline + 1:].tobytes()
+
+            features, labels = parse_lines(data[:last_newline + 1], num_cells)
+            feature_blocks.append(features)
+            label_blocks.append(labels)
+
+    if len(feature_blocks) == 0:
+        return DigitDataset(np.zeros((0, num_cells), dtype=np.uint8),
+            np.zeros(0, dtype='U1'), num_rows, num_cols)
+    return DigitDataset(np.concatenate(feature_blocks),
+        np.concatenate(label_blocks), num_rows, num_cols)
+
+# Load the digits from either a digit_data.txt style file or, if
+# idx_images_path is given, a pair of IDX (MNIST format) files.
+# Any labelled drawings in the file's log are added at the end.
+def load_dataset(path='digit_data.txt', idx_images_path=None, idx_labels_path=None,
+    num_rows=NUM_ROWS, num_cols=NUM_COLS):
+    if idx_images_path:
+        dataset = load_idx(idx_images_path, idx_labels_path, num_rows, num_cols)
+        path = idx_images_path
+    else:
+        dataset = load_digits(path, num_rows, num_cols)
+
+    log = load_log(log_path(path), num_rows, num_cols)
+    if log is None or len(log) == 0:
+        return dataset
+
+    # The log changes the data, so it changes the hash too.
+    source_hash = None
+    if dataset.source_hash:
+        source_hash = hashlib.sha256((dataset.source_hash + file_hash(log_path(path))).encode()).hexdigest()
+    return DigitDataset(np.concatenate((dataset.features, log.features)),
+        np.concatenate((dataset.labels, log.labels)), num_rows, num_cols, source_hash)
+
+# Return the path of the log of labelled drawings for a data file.
+def log_path(path):
+    return path + '.log'
+
+# Return the number of bytes in each log record.
+def log_record_bytes(num_cells):
+    return 1 + (num_cells + 7) // 8
+
+# Append a labelled drawing to a log, creating the log if necessary.
+#     name:      The digit's name, a single character.
+#     features:  The drawing's 0s and 1s.
+def append_log(path, name, features, num_rows=NUM_ROWS, num_cols=NUM_COLS):
+    features = np.asarray(features, dtype=np.uint8)
+    if len(features) != num_rows * num_cols:
+        raise ValueError(f'A drawing must hold {num_rows * num_cols} 0s and 1s')
+    record = name.encode('ascii') + np.packbits(features).tobytes()
+    if len(name) != 1 or len(record) != log_record_bytes(len(features)):
+        raise ValueError('A drawing\'s name must be a single character')
+
+    with open(path, 'ab') as f:
+        size = f.tell()
+        if size == 0:
+            f.write(LOG_MAGIC + bytes([LOG_VERSION]) + np.array([num_rows, num_cols], dtype='<u2').tobytes())
+        else:
+            read_log_header(path, num_rows, num_cols)
+
+            # Drop any partial record left by a write that was interrupted.
+            extra = (size - LOG_HEADER_BYTES) % len(record)
+            if extra:
+                f.truncate(size - extra)
+        f.write(record)
+
+# Make sure a log's header matches this version and grid.
+def read_log_header(path, num_rows, num_cols):
+    with open(path, 'rb') as f:
+        header = f.read(LOG_HEADER_BYTES)
+    if len(header) != LOG_HEADER_BYTES or not header.startswith(LOG_MAGIC) or \
+        header[len(LOG_MAGIC)] != LOG_VERSION:
+        raise ValueError(f'{path} is not a digit log')
+    rows, cols = np.frombuffer(header[len(LOG_MAGIC) + 1:], dtype='<u2')
+    if rows != num_rows or cols != num_cols:
+        raise ValueError(f'{path} holds {rows} x {cols} drawings, not {num_rows} x {num_cols}')
+
+# Load a log of labelled drawings.
+# Return a DigitDataset, or None if there is no log.
+def load_log(path, num_rows=NUM_ROWS, num_cols=NUM_COLS):
+    if not os.path.exists(path):
+        return None
+    read_log_header(path, num_rows, num_cols)
+
+    # Read the whole records. A partial record at the end is ignored.
+    num_cells = num_rows * num_cols
+    data = np.fromfile(path, dtype=np.uint8, offset=LOG_HEADER_BYTES)
+    record_bytes = log_record_bytes(num_cells)
+    records = data[:len(data) - len(data) % record_bytes].reshape(-1, record_bytes)
+
+    labels = np.ascontiguousarray(records[:, 0]).view('S1').astype('U1')
+    features = np.unpackbits(records[:, 1:], axis=1, count=num_cells)
+    return DigitDataset(features, labels, num_rows, num_cols)
+
+# Memory-map an IDX file of unsigned bytes.
+# Return an array with the file's dimensions.
+def map_idx(path):
+    with open(path, 'rb') as f:
+        header = f.read(4)
+        if len(header) != 4 or header[0] != 0 or header[1] != 0:
+            raise ValueError(f'{path} is not an IDX file')
+        if header[2] != 0x08:
+            raise ValueError(f'{path} does not hold unsigned bytes')
+        num_dimensions = header[3]
+        shape = tuple(np.frombuffer(f.read(4 * num_dimensions), dtype='>u4').astype(int))
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=4 + 4 * num_dimensions, shape=shape)
+
+# Load IDX (MNIST format) image and label files, shrinking each image
+# to a num_rows x num_cols grid of 0s and 1s. The files are memory-mapped
+# and converted IDX_CHUNK_IMAGES images at a time, so only the small
+# grid features are ever held in memory.
+def load_idx(images_path, labels_path, num_rows=NUM_ROWS, num_cols=NUM_COLS, threshold=IDX_THRESHOLD):
+    images = map_idx(images_path)
+    labels = map_idx(labels_path)
+    if images.ndim != 3 or labels.ndim != 1 or len(images) != len(labels):
+        raise ValueError('The IDX files must hold matching images and labels')
+
+    # Find the pixel rows and columns where each grid cell starts.
+    height, width = images.shape[1:]
+    row_starts = np.arange(num_rows) * height // num_rows
+    col_starts = np.arange(num_cols) * width // num_cols
+    cell_sizes = np.outer(np.diff(np.append(row_starts, height)), np.diff(np.append(col_starts, width)))
+
+    features = np.empty((len(images), num_rows * num_cols), dtype=np.uint8)
+    for start in range(0, len(images), IDX_CHUNK_IMAGES):
+        # Add up the pixels in each cell and compare the average to the threshold.
+        block = np.asarray(images[start:start + IDX_CHUNK_IMAGES], dtype=np.uint32)
+        sums = np.add.reduceat(np.add.reduceat(block, row_starts, axis=1), col_starts, axis=2)
+        averages = sums / (cell_sizes * 255)
+        features[start:start + len(block)] = (averages >= threshold).reshape(len(block), -1)
+
+    names = (np.asarray(labels) + ord('0')).astype(np.uint8).view('S1').astype('U1')
+    return DigitDataset(features, names, num_rows, num_cols)
+
+# Add command-line arguments that choose the data to load.
+# The defaults are the app's own settings.
+def add_data_arguments(parser, data_file='digit_data.txt', num_rows=NUM_ROWS, num_cols=NUM_COLS):
+    parser.add_argument('--data', default=data_file,
+        help=f'file in the digit_data.txt format (default {data_file})')
+    parser.add_argument('--idx-images', help='IDX (MNIST format) image file to use instead')
+    parser.add_argument('--idx-labels', help='IDX (MNIST format) label file to use instead')
+    parser.add_argument('--rows', type=int, default=num_rows, help=f'grid rows (default {num_rows})')
+    parser.add_argument('--cols', type=int, default=num_cols, help=f'grid columns (default {num_cols})')
+
+# Return the data settings from parsed command-line arguments
+# as keyword arguments for an app's constructor.
+def data_options(args):
+    return {
+        'data_file': args.data,
+        'idx_images_file': args.idx_images,
+        'idx_labels_file': args.idx_labels,
+        'num_rows': args.rows,
+        'num_cols': args.cols,
+    }
+
+# Return a hash that identifies a dataset's contents and grid size.
+# Data loaded through the cache already has its file's hash.
+# Otherwise hash the arrays themselves.
+def dataset_hash(dataset):
+    hasher = hashlib.sha256(f'{dataset.num_rows}x{dataset.num_cols}'.encode())
+    if dataset.source_hash:
+        hasher.update(dataset.source_hash.encode())
+    else:
+        hasher.update(np.ascontiguousarray(dataset.features).tobytes())
+        hasher.update(np.ascontiguousarray(dataset.labels).tobytes())
+    return hasher.hexdigest()
+
+# Return the key for a model trained on a dataset with the given
+# training parameters (a dictionary that can be saved as JSON).
+def model_key(dataset, params):
+    text = json.dumps({'dataset': dataset_hash(dataset), 'params': params}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# Save a trained model in a directory.
+#     key:     The model_key for the data and parameters it was trained with.
+#     arrays:  A dictionary of arrays, each saved as a .npy file.
+#     values:  A dictionary of small values that can be saved as JSON.
+# meta.json is written last, so a half-written model is never used.
+def save_model(directory, key, arrays, values):
+    save_arrays(directory, arrays)
+    meta = {
+        'version': MODEL_VERSION,
+        'key': key,
+        'arrays': sorted(arrays),
+        'values': values,
+    }
+    save_meta(directory, meta)
+
+# Load a model saved by save_model. The arrays are memory-mapped read-only.
+# Return a dictionary holding the arrays and values, or None if there is
+# no model or it was saved with another version or key.
+def load_model(directory, key):
+    try:
+        with open(os.path.join(directory, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != MODEL_VERSION or meta.get('key') != key:
+        return None
+
+    model = dict(meta['values'])
+    try:
+        for name in meta['arrays']:
+            model[name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return model
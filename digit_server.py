@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Digit Server
+# Train one of the digit classifiers once and serve it over localhost HTTP
+# so other processes can classify patterns without loading the data.
+#
+# POST /classify with a JSON body like {"patterns": ["0111...", ...]}
+# returns {"digits": ["6", ...]}. GET /stats returns the latency
+# percentiles and throughput so far.
+#
+# Requests that arrive close together are gathered into one batch and
+# classified with a single vectorized classify_patterns call.
+#
+# Usage: python digit_server.py [--model knn|k-means|naive-bayes] [--port 8000]
+
+
+import argparse
+import collections
+import importlib
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from digit_loader import NUM_COLS, NUM_ROWS, add_data_arguments, data_options
+
+# The classifiers that can be served: the module that holds
+# each one and the name of its headless engine class.
+# (The k-means file name has a hyphen, so it is imported by name.)
+ENGINES = {
+    'knn': ('knn_digits_starter_solution', 'KnnDigits'),
+    'k-means': ('k-means_digits_starter_solution', 'KMeansDigits'),
+    'naive-bayes': ('naive_bayes_digits_starter_solution', 'NaiveBayesDigits'),
+}
+
+# Server settings.
+HOST = '127.0.0.1'
+PORT = 8000
+
+# A batch is classified when it holds MAX_BATCH_PATTERNS patterns or
+# MAX_WAIT_MS milliseconds after its first request arrived.
+MAX_BATCH_PATTERNS = 256
+MAX_WAIT_MS = 2
+
+# Number of recent request latencies used for the percentiles.
+LATENCY_WINDOW = 10000
+
+# Number of connections that can wait to be accepted. Many clients
+# connecting at once is the case that batching is for.
+LISTEN_BACKLOG = 1024
+
+
+# A request waiting for its batch to be classified.
+class PendingRequest:
+    def __init__(self, features):
+        self.features = features
+        self.start_time = time.perf_counter()
+        self.done = threading.Event()
+        self.names = None
+        self.error = None
+
+
+# Gathers requests from many threads into batches and classifies
+# each batch with one call to classify_patterns in its own thread.
+class MicroBatcher:
+    def __init__(self, classify_patterns, max_batch_patterns=MAX_BATCH_PATTERNS, max_wait_ms=MAX_WAIT_MS):
+        self.classify_patterns = classify_patterns
+        self.max_batch_patterns = max_batch_patterns
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+
+        # Statistics.
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.num_requests = 0
+        self.num_patterns = 0
+        self.num_batches = 0
+        self.start_time = time.perf_counter()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Classify the rows of features along with any other requests
+    # that arrive at about the same time. Return their names.
+    def classify(self, features):
+        request = PendingRequest(features)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.names
+
+    # Classify batches of requests until the program ends.
+    def run(self):
+        while True:
+            # Wait for a request, then gather more until the
+            # batch is full or its time is up.
+            batch = [self.requests.get()]
+            num_patterns = len(batch[0].features)
+            deadline = time.perf_counter() + self.max_wait
+            while num_patterns < self.max_batch_patterns:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0: break
+                try:
+                    request = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_patterns += len(request.features)
+
+            self.classify_batch(batch)
+
+    # Classify a batch's patterns at once and give each request its names.
+    def classify_batch(self, batch):
+        try:
+            names = self.classify_patterns(np.concatenate([request.features for request in batch]))
+        except Exception as error:
+            for request in batch:
+                request.error = error
+                request.done.set()
+            return
+
+        start = 0
+        end_time = time.perf_counter()
+        with self.lock:
+            for request in batch:
+                request.names = names[start:start + len(request.features)]
+                start += len(request.features)
+                self.latencies.append(end_time - request.start_time)
+                self.num_patterns += len(request.features)
+            self.num_requests += len(batch)
+            self.num_batches += 1
+        for request in batch:
+            request.done.set()
+
+    # Return a dictionary holding the latency percentiles
+    # in milliseconds and the throughput so far.
+    def stats(self):
+        with self.lock:
+            latencies = 1000 * np.array(self.latencies)
+            elapsed = time.perf_counter() - self.start_time
+            result = {
+                'requests': self.num_requests,
+                'patterns': self.num_patterns,
+                'batches': self.num_batches,
+                'mean_batch_requests': self.num_requests / max(self.num_batches, 1),
+                'requests_per_second': self.num_requests / elapsed,
+                'patterns_per_second': self.num_patterns / elapsed,
+            }
+        for percentile in [50, 90, 99]:
+            result[f'p{percentile}_ms'] = float(np.percentile(latencies, percentile)) if len(latencies) else None
+        return result
+
+
+# A threaded HTTP server that holds a MicroBatcher
+# and the number of cells in each pattern.
+class DigitServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, address, batcher, num_cells):
+        ThreadingHTTPServer.__init__(self, address, DigitRequestHandler)
+        self.batcher = batcher
+        self.num_cells = num_cells
+
+
+# Handles one HTTP request.
+class DigitRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.batcher.stats())
+        else:
+            self.send_json(404, {'error': 'Use POST /classify or GET /stats'})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self.send_json(404, {'error': 'Use POST /classify or GET /stats'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            features = self.parse_patterns(json.loads(self.rfile.read(length)))
+        except ValueError as error:
+            self.send_json(400, {'error': str(error)})
+            return
+
+        # A failed batch is re-raised in every waiting handler. Answer it
+        # with an error instead of dropping the connection.
+        try:
+            names = self.server.batcher.classify(features)
+        except Exception as error:
+            self.send_json(500, {'error': str(error)})
+            return
+        self.send_json(200, {'digits': [str(name) for name in names]})
+
+    # Convert the request's patterns into a matrix of 0s and 1s.
+    def parse_patterns(self, body):
+        patterns = body.get('patterns') if isinstance(body, dict) else None
+        if not isinstance(patterns, list) or len(patterns) == 0:
+            raise ValueError('The body must be {"patterns": ["0101...", ...]}')
+
+        num_cells = self.server.num_cells
+        for pattern in patterns:
+            if not isinstance(pattern, str) or len(pattern) != num_cells or pattern.strip('01'):
+                raise ValueError(f'Each pattern must hold {num_cells} 0s and 1s')
+        text = ''.join(patterns).encode('ascii')
+        return (np.frombuffer(text, dtype=np.uint8) - ord('0')).reshape(len(patterns), num_cells)
+
+    def send_json(self, status, value):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Don't print a line for every request.
+    def log_message(self, format, *args):
+        pass
+
+
+# Load the data and train (or load) the model for one of the ENGINES.
+# Return the trained engine.
+def train_engine(model, min_k, max_k, retrain, **data_options):
+    module_name, class_name = ENGINES[model]
+    engine = getattr(importlib.import_module(module_name), class_name)(**data_options)
+    engine.load_data()
+    if model == 'naive-bayes':
+        engine.train(retrain)
+    else:
+        engine.train(min_k, max_k, retrain)
+    return engine
+
+# Make an HTTP server that classifies patterns with a trained engine.
+def make_server(engine, host=HOST, port=PORT,
+    max_batch_patterns=MAX_BATCH_PATTERNS, max_wait_ms=MAX_WAIT_MS):
+    batcher = MicroBatcher(engine.classify_patterns, max_batch_patterns, max_wait_ms)
+    return DigitServer((host, port), batcher, engine.num_rows * engine.num_cols)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a digit classifier over localhost HTTP.')
+    parser.add_argument('--model', choices=sorted(ENGINES), default='knn', help='classifier to serve')
+    add_data_arguments(parser, 'digit_data.txt', NUM_ROWS, NUM_COLS)
+    parser.add_argument('--min-k', type=int, default=3, help='smallest K to test (KNN and k-means)')
+    parser.add_argument('--max-k', type=int, default=20, help='largest K to test (KNN and k-means)')
+    parser.add_argument('--retrain', action='store_true', help='train even if there is a saved model')
+    parser.add_argument('--host', default=HOST, help=f'address to listen on (default {HOST})')
+    parser.add_argument('--port', type=int, default=PORT, help=f'port to listen on (default {PORT})')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH_PATTERNS,
+        help=f'most patterns to classify at once (default {MAX_BATCH_PATTERNS})')
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS,
+        help=f'longest time to wait for more requests (default {MAX_WAIT_MS})')
+    args = parser.parse_args()
+
+    engine = train_engine(args.model, args.min_k, args.max_k, args.retrain, **data_options(args))
+    server = make_server(engine, args.host, args.port, args.max_batch, args.max_wait_ms)
+    print(f'Serving {args.model} on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.batcher.stats(), indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -35,6 +35,10 @@ def make_field(parent, label_width, label_text, entry_width, entry_default):
 
 import math
 
+# The bounded assignment tests must beat their bounds by this much
+# so rounding and ties cannot change which seed a point gets.
+BOUND_EPSILON = 1e-9
+
 class DataPoint:
     POINT_RADIUS = 2
     POINT_COLOR = 'black'
@@ -47,6 +51,14 @@ class DataPoint:
         self.color = color
         self.seed = None
 
+        # Bounds used by assign_seed_bounded. The distance to this
+        # point's seed is at most upper, and the distance to seeds[i]
+        # is at least lower[i]. A seed's distance_moved is how far
+        # it moved the last time it was repositioned.
+        self.upper = math.inf
+        self.lower = []
+        self.distance_moved = 0
+
         # Make the DataPoint's oval.
         self.oval = self.canvas.create_oval(
             x - self.radius, y - self.radius, x + self.radius, y + self.radius,
@@ -77,6 +89,56 @@ class DataPoint:
         self.seed = closest_seed
         self.set_color(closest_seed.color)
 
+    # Assign this data point to the closest seed like assign_seed, but
+    # skip the seeds that cannot be closer than the best one so far
+    # (Elkan's algorithm). The bounds move by the distances that the
+    # seeds moved since the last call, so this must be called after
+    # every round of reposition_seed calls. gaps[i][j] is the distance
+    # between seeds i and j. Return the number of distances computed.
+    def assign_seed_bounded(self, seeds, gaps):
+        # If this point has no seed yet, compute all of the distances.
+        if self.seed not in seeds or len(self.lower) != len(seeds):
+            self.lower = [self.distance(seed) for seed in seeds]
+            best = min(range(len(seeds)), key=lambda i: self.lower[i])
+            self.upper = self.lower[best]
+            self.seed = seeds[best]
+            self.set_color(self.seed.color)
+            return len(seeds)
+
+        # Move the bounds by the distances that the seeds moved.
+        best = seeds.index(self.seed)
+        self.upper += self.seed.distance_moved
+        for i in range(len(seeds)):
+            self.lower[i] -= seeds[i].distance_moved
+
+        num_computed = 0
+        upper_is_exact = False
+        for i in range(len(seeds)):
+            # Skip this seed if it must be farther away than the best seed.
+            if i == best or self.upper + BOUND_EPSILON < max(self.lower[i], gaps[best][i] / 2):
+                continue
+
+            # Make the upper bound exact and try again.
+            if not upper_is_exact:
+                self.upper = self.distance(seeds[best])
+                self.lower[best] = self.upper
+                upper_is_exact = True
+                num_computed += 1
+                if self.upper + BOUND_EPSILON < max(self.lower[i], gaps[best][i] / 2):
+                    continue
+
+            # Compute the distance. Like assign_seed, ties go to the first seed.
+            distance = self.distance(seeds[i])
+            self.lower[i] = distance
+            num_computed += 1
+            if distance < self.upper or (distance == self.upper and i < best):
+                self.upper = distance
+                best = i
+
+        if self.seed is not seeds[best]:
+            self.seed = seeds[best]
+            self.set_color(self.seed.color)
+        return num_computed
 
     # Reposition this seed given its currently assigned data points.
     # Return the distance moved.
@@ -104,6 +166,7 @@ class DataPoint:
             dx = self.x - old_x
             dy = self.y - old_y
             distance_moved = math.sqrt(dx**2 + dy**2)
+        self.distance_moved = distance_moved
 
         # Make the point move its oval to the new location.
         self.move()
@@ -137,6 +200,17 @@ SEED_RADIUS = 5
 # Stop running when the seeds are not moving more than this distance.
 STOP_DISTANCE = 1
 
+# If BOUNDED_ASSIGNMENT is True, use assign_seed_bounded to skip
+# distances that cannot change any point's seed. The seeds end up in
+# the same places. If PRINT_SKIPPED is also True, print how many
+# distances were skipped in each tick.
+BOUNDED_ASSIGNMENT = False
+PRINT_SKIPPED = False
+
+# If KMEANS_PLUS_PLUS is True, pick the first seeds with k-means++
+# so they start out spread apart. Otherwise pick random points.
+KMEANS_PLUS_PLUS = False
+
 # Define some seed colors.
 colors = [
     'red', 'lightgreen', 'blue', 'pink', 'green',
@@ -272,7 +346,10 @@ class App:
 
     def create_seeds(self, num_clusters, colors):
         # Pick a random selection of num_clusters objects from the data_points list
-        random_points = random.sample(self.data_points, num_clusters)
+        if KMEANS_PLUS_PLUS:
+            random_points = self.kmeans_plus_plus_points(num_clusters)
+        else:
+            random_points = random.sample(self.data_points, num_clusters)
 
         # Create a new list of seeds
         self.seeds = []
@@ -282,6 +359,32 @@ class App:
             self.seeds.append(new_seed)
 
 
+    # Pick num_clusters data points with k-means++. The first point is
+    # picked at random. Each point after that is picked with probability
+    # proportional to its squared distance to the closest point picked so far.
+    def kmeans_plus_plus_points(self, num_clusters):
+        points = [random.choice(self.data_points)]
+        closest = [point.distance(points[0]) ** 2 for point in self.data_points]
+        while len(points) < num_clusters:
+            # Pick a point. If the rest are all on top of
+            # picked points, pick any point.
+            total = sum(closest)
+            if total == 0:
+                new_point = random.choice(self.data_points)
+            else:
+                target = random.random() * total
+                for i in range(len(closest)):
+                    target -= closest[i]
+                    if target < 0:
+                        break
+                new_point = self.data_points[i]
+            points.append(new_point)
+
+            # Update the distances to the closest picked points.
+            for i in range(len(closest)):
+                closest[i] = min(closest[i], self.data_points[i].distance(new_point) ** 2)
+        return points
+
     def run(self):
         # See if we are currently running.
         if self.running:
@@ -310,8 +413,20 @@ class App:
 
     # Assign points to their nearest seeds.
     def assign_points_to_seeds(self):
+        if not BOUNDED_ASSIGNMENT:
+            for point in self.data_points:
+                point.assign_seed(self.seeds)
+            return
+
+        # Find the distances between the seeds.
+        gaps = [[seed.distance(other) for other in self.seeds] for seed in self.seeds]
+
+        num_computed = 0
         for point in self.data_points:
-            point.assign_seed(self.seeds)
+            num_computed += point.assign_seed_bounded(self.seeds, gaps)
+        if PRINT_SKIPPED:
+            num_distances = len(self.data_points) * len(self.seeds)
+            print(f'Skipped {num_distances - num_computed} of {num_distances} distance computations')
 
     # Reposition the seeds.
     # Return the largest distance that any seed moves.
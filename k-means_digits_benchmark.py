@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # K-means Digits Benchmark
+# Compare the ways of picking the first seeds: the number of Lloyd
+# iterations they need and the time a whole test_ks sweep takes.
+# Usage: python k-means_digits_benchmark.py [--min-k 3] [--max-k 20] [--runs 3]
+
+
+import argparse
+import contextlib
+import importlib
+import io
+import random
+import time
+
+from digit_loader import add_data_arguments, data_options
+
+# The k-means file name has a hyphen, so it is imported by name.
+k_means_digits = importlib.import_module('k-means_digits_starter_solution')
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare k-means seed initializers.')
+    add_data_arguments(parser, k_means_digits.DATA_FILE, k_means_digits.NUM_ROWS, k_means_digits.NUM_COLS)
+    parser.add_argument('--min-k', type=int, default=3, help='smallest K to test')
+    parser.add_argument('--max-k', type=int, default=20, help='largest K to test')
+    parser.add_argument('--runs', type=int, default=3, help='sweeps to time for each initializer')
+    args = parser.parse_args()
+
+    engine = k_means_digits.KMeansDigits(**data_options(args))
+    engine.load_data()
+    num_finds = (args.max_k - args.min_k + 1) * k_means_digits.NUM_TRIALS
+
+    print(f'{"Init":>10} {"Iterations":>11} {"Per trial":>10} {"Sweep s":>10} {"Best K":>7} {"Success":>8}')
+    for seed_init in k_means_digits.SEED_INITS:
+        engine.seed_init = seed_init
+        engine.num_iterations = 0
+        elapsed = 0
+        success_rates = []
+        for run in range(args.runs):
+            # Use the same random numbers for each initializer.
+            random.seed(run)
+            start_time = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                engine.test_ks(args.min_k, args.max_k)
+            elapsed += time.perf_counter() - start_time
+            success_rates.append(engine.success_rate)
+
+        iterations = engine.num_iterations / args.runs
+        print(f'{seed_init:>10} {iterations:>11.0f} {iterations / num_finds:>10.2f} '
+            f'{elapsed / args.runs:>10.3f} {engine.k:>7} {sum(success_rates) / args.runs:>7.1f}%')
+
+
+if __name__ == '__main__':
+    main()
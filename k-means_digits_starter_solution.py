@@ -8,6 +8,8 @@
 
 
 import math
+import random
+import numpy as np
 
 class DataPoint:
     # The data_string parameter is a string holding the digit, 0s, and 1s
@@ -108,11 +110,290 @@ class DataPoint:
             self.name = max(votes, key=lambda x:votes[x])
 
 
+# Make a seed DataPoint with the given name and property values.
+def make_seed(name, properties):
+    seed = DataPoint(f'{name}: {"0" * len(properties)}')
+    seed.properties = list(properties)
+    return seed
+
+
+# Array-backed Lloyd iteration.
+# These work on a matrix of 0s and 1s (one row per point) and a matrix
+# of centroids (one row per seed) instead of DataPoint objects. Each
+# point's seed is stored as a number in a labels array. The distances
+# are added up one property at a time in the same order as
+# DataPoint.distance, so the results match the DataPoint methods exactly.
+
+# Return a matrix holding the distance from each row of features to each centroid.
+def centroid_distances(features, centroids):
+    totals = np.zeros((len(features), len(centroids)))
+    for i in range(centroids.shape[1]):
+        totals += np.abs(features[:, i, None] - centroids[None, :, i])
+    return np.sqrt(totals)
+
+# Return the distance from each row of features to the centroid
+# given by its label. These equal the matching centroid_distances.
+def assigned_distances(features, centroids, labels):
+    totals = np.zeros(len(features))
+    for i in range(centroids.shape[1]):
+        totals += np.abs(features[:, i] - centroids[labels, i])
+    return np.sqrt(totals)
+
+# Return the number of the closest centroid to each row of features.
+# Like assign_seed, ties go to the first centroid.
+def nearest_centroids(features, centroids):
+    return np.argmin(centroid_distances(features, centroids), axis=1)
+
+# Move each centroid to the average of the points assigned to it,
+# like reposition_seed. A centroid with no points does not move.
+# Return the new centroids and the largest distance that any moved.
+def move_centroids(features, labels, centroids):
+    # Add up each centroid's points with one grouped sum.
+    counts = np.bincount(labels, minlength=len(centroids))
+    sums = np.zeros(centroids.shape, dtype=np.int64)
+    np.add.at(sums, labels, features)
+
+    assigned = counts > 0
+    new_centroids = centroids.copy()
+    new_centroids[assigned] = sums[assigned] / counts[assigned, None]
+
+    # Find how far each centroid moved.
+    moves = assigned_distances(new_centroids, centroids, np.arange(len(centroids)))
+    return new_centroids, max(0, moves.max(initial=0))
+
+# Return the index of a random row, picked with probability
+# proportional to its weight. If the weights are all 0, pick any row.
+def weighted_index(weights):
+    total = weights.sum()
+    if total <= 0:
+        return random.randrange(len(weights))
+    index = np.searchsorted(np.cumsum(weights), random.random() * total, side='right')
+    return int(min(index, len(weights) - 1))
+
+# Return a random ordering of the numbers 0 through n - 1 as an array.
+# It is seeded from the random module, so --seed makes it repeatable.
+def random_permutation(n):
+    return np.random.default_rng(random.getrandbits(64)).permutation(n)
+
+# Return the indexes of k rows of features to use as the first
+# centroids, picked by k-means++. The first row is picked at random.
+# Each row after that is picked with probability proportional to its
+# squared distance to the closest row picked so far (times its weight,
+# if there are weights), so the centroids start out spread apart.
+def kmeans_plus_plus_indexes(features, k, weights=None):
+    # The squared distance is the L1 distance, which is
+    # found for all of the rows at once with one sum.
+    points = features.astype(np.float64)
+    if weights is None:
+        weights = np.ones(len(points))
+    indexes = [weighted_index(weights)]
+    closest = np.abs(points - points[indexes[0]]).sum(axis=1)
+    while len(indexes) < k:
+        index = weighted_index(weights * closest)
+        indexes.append(index)
+        closest = np.minimum(closest, np.abs(points - points[index]).sum(axis=1))
+    return indexes
+
+# Return the indexes of k rows of features to use as the first
+# centroids, picked by k-means|| (scalable k-means++). Instead of
+# picking one row per pass, each of KMEANS_PARALLEL_ROUNDS passes picks
+# about KMEANS_PARALLEL_OVERSAMPLING * k rows at once, each with
+# probability proportional to its squared distance to the closest
+# row picked so far. Then k-means++ picks k of those rows, weighting
+# each by the number of rows that are closest to it.
+KMEANS_PARALLEL_OVERSAMPLING = 2
+KMEANS_PARALLEL_ROUNDS = 5
+
+def kmeans_parallel_indexes(features, k):
+    # Use floats, since subtracting 0s and 1s stored as
+    # unsigned bytes would wrap around to 255.
+    points = features.astype(np.float64)
+    rng = np.random.default_rng(random.getrandbits(64))
+    candidates = [random.randrange(len(points))]
+    closest = centroid_distances(points, points[candidates])[:, 0] ** 2
+    for pass_number in range(KMEANS_PARALLEL_ROUNDS):
+        total = closest.sum()
+        if total <= 0:
+            break
+        chosen = np.flatnonzero(rng.random(len(points)) < KMEANS_PARALLEL_OVERSAMPLING * k * closest / total)
+        if len(chosen) == 0:
+            continue
+        candidates.extend(chosen.tolist())
+        closest = np.minimum(closest, (centroid_distances(points, points[chosen]) ** 2).min(axis=1))
+
+    # Make sure there are at least k candidates.
+    if len(candidates) < k:
+        others = np.setdiff1d(np.arange(len(points)), candidates)
+        candidates.extend(others[random.sample(range(len(others)), k - len(candidates))].tolist())
+
+    weights = np.bincount(nearest_centroids(points, points[candidates]), minlength=len(candidates))
+    return [candidates[i] for i in kmeans_plus_plus_indexes(points[candidates], k, weights)]
+
+
+# Assigns points to their nearest centroids like nearest_centroids,
+# but skips distances that cannot change the result (Elkan's
+# algorithm). For each point it keeps an upper bound on the distance
+# to its centroid and a lower bound on the distance to each centroid.
+# When the centroids move, the bounds grow and shrink by the distances
+# moved instead of being computed again. The distance from a point to
+# another centroid is only computed if the upper bound is not less
+# than that centroid's lower bound and half the distance between the
+# two centroids.
+#
+# The square root of the L1 distance obeys the triangle inequality,
+# so these tests are safe. They must beat the bound by BOUND_EPSILON
+# so rounding and ties (which go to the first centroid) cannot make
+# the result differ from nearest_centroids.
+BOUND_EPSILON = 1e-9
+
+class BoundedAssignment:
+    def __init__(self, features):
+        self.features = features
+        self.labels = None
+        self.centroids = None
+        self.upper = None
+        self.lower = None
+
+        # The number of distance computations skipped by each assign call.
+        self.skipped = []
+
+    # Assign each point to its nearest centroid. Return the labels.
+    def assign(self, centroids):
+        all_rows = np.arange(len(self.features))
+
+        # The first time, compute all of the distances.
+        if self.labels is None:
+            self.lower = centroid_distances(self.features, centroids)
+            self.labels = np.argmin(self.lower, axis=1)
+            self.upper = self.lower[all_rows, self.labels]
+            self.centroids = centroids.copy()
+            self.skipped.append(0)
+            return self.labels
+
+        # Move the bounds by the distances that the centroids moved.
+        moves = assigned_distances(centroids, self.centroids, np.arange(len(centroids)))
+        self.centroids = centroids.copy()
+        self.upper += moves[self.labels]
+        self.lower -= moves
+
+        # A centroid is a candidate for a point if the point's
+        # upper bound is not less than both of its bounds.
+        gaps = centroid_distances(centroids, centroids)
+        bounds = np.maximum(self.lower, gaps[self.labels] / 2)
+        bounds[all_rows, self.labels] = np.inf
+        candidates = self.upper[:, None] + BOUND_EPSILON >= bounds
+
+        # Compute the exact distances to their centroids for the points
+        # with candidates, and see which candidates are left.
+        rows = np.flatnonzero(candidates.any(axis=1))
+        self.upper[rows] = assigned_distances(self.features[rows], centroids, self.labels[rows])
+        self.lower[rows, self.labels[rows]] = self.upper[rows]
+        num_computed = len(rows)
+        candidates[rows] &= self.upper[rows, None] + BOUND_EPSILON >= bounds[rows]
+
+        # Compute the distances to the remaining candidates.
+        rows, cols = np.nonzero(candidates)
+        self.lower[rows, cols] = assigned_distances(self.features[rows], centroids, cols)
+        num_computed += len(rows)
+
+        # Pick the closest of each point's centroid and its candidates.
+        # The other centroids are farther away than the point's centroid.
+        rows = np.unique(rows)
+        distances = np.where(candidates[rows], self.lower[rows], np.inf)
+        distances[np.arange(len(rows)), self.labels[rows]] = self.upper[rows]
+        self.labels[rows] = np.argmin(distances, axis=1)
+        self.upper[rows] = distances.min(axis=1)
+
+        self.skipped.append(self.lower.size - num_computed)
+        return self.labels
+
+
+# Return the name of each centroid: the most common name of the
+# points assigned to it, or '?' if it has none. Like assign_name,
+# a tie goes to the name that appears first in names.
+def centroid_names(labels, names, num_centroids):
+    result = []
+    for c in range(num_centroids):
+        members = names[labels == c]
+        if len(members) == 0:
+            result.append('?')
+            continue
+        unique_names, first_indexes, counts = np.unique(members, return_index=True, return_counts=True)
+        order = np.argsort(first_indexes)
+        result.append(str(unique_names[order[np.argmax(counts[order])]]))
+    return np.array(result)
+
+
 # In[ ]:
 
 
-import tkinter as tk
-import random
+import argparse
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from digit_loader import add_data_arguments, data_options, load_dataset, load_model, model_key, save_model
+
+# Clustering settings.
+# Each K is tried NUM_TRIALS times with different random seeds. Each
+# trial stops after MAX_ITERATIONS or when no seed moves STOP_DISTANCE.
+NUM_TRIALS = 20  # Maybe use a bigger number like 100.
+MAX_ITERATIONS = 1000
+STOP_DISTANCE = 1
+
+# If ARRAY_ENGINE is True, find_clusters uses the array-backed Lloyd
+# iteration functions. Otherwise it uses the DataPoint methods.
+# Both find the same clusters.
+ARRAY_ENGINE = True
+
+# If BOUNDED_ASSIGNMENT is True, the array engine uses BoundedAssignment
+# to skip distance computations that cannot change any point's seed.
+# It finds the same clusters either way. Keeping the bounds costs
+# about as much as it saves for digit_data.txt, so this is for larger
+# data sets. If PRINT_SKIPPED is True, it prints the number of
+# distances skipped in each iteration.
+BOUNDED_ASSIGNMENT = False
+PRINT_SKIPPED = False
+
+# Mini-batch k-means settings. If the mini-batch size is 0, each
+# iteration uses all of the training points. Otherwise each iteration
+# moves the seeds toward a random batch of that many points, so the
+# time per K stays about the same however many points there are.
+# A mini-batch run stops after MAX_ITERATIONS batches or when the
+# smoothed average distance from the batch points to their seeds has
+# not improved by MINI_BATCH_STOP_CHANGE for MINI_BATCH_PATIENCE
+# batches in a row. MINI_BATCH_SMOOTHING is the weight given to each
+# new batch in the smoothed distance. The first seeds are picked from,
+# and the seeds are named with, a random sample of at most
+# MINI_BATCH_SAMPLE_POINTS training points, and the success rate is
+# measured on a random sample of at most that many test points.
+MINI_BATCH_SIZE = 0
+MINI_BATCH_SMOOTHING = 0.1
+MINI_BATCH_STOP_CHANGE = 0.001
+MINI_BATCH_PATIENCE = 10
+MINI_BATCH_SAMPLE_POINTS = 10000
+
+# How to pick the first seeds: 'random' picks k random training
+# points, 'k-means++' uses kmeans_plus_plus_indexes, and 'k-means||'
+# uses kmeans_parallel_indexes. See k-means_digits_benchmark.py.
+SEED_INIT = 'random'
+SEED_INITS = ['random', 'k-means++', 'k-means||']
+
+# If NUM_WORKERS is more than 0, test_ks runs the (K, trial) jobs in
+# that many worker processes. Each job seeds its own random numbers
+# from one master seed, so the results are the same for any number of
+# workers. (They differ from the results with NUM_WORKERS = 0, where
+# the trials share one stream of random numbers.)
+NUM_WORKERS = 0
+
+# The best seeds are saved here after training. Later runs on the same
+# data with the same settings load them instead of clustering again.
+MODEL_DIRECTORY = 'k-means_digits.model'
+
+# How often, in milliseconds, the App checks for progress
+# messages from the training thread.
+TRAINING_POLL_MS = 100
 
 # Geometry constants.
 NUM_ROWS = 8
@@ -120,163 +401,135 @@ NUM_COLS = 6
 CELL_WID = 20
 CELL_HGT = CELL_WID
 MARGIN = 5
-WINDOW_WID = NUM_COLS * CELL_WID + 100
-WINDOW_HGT = NUM_ROWS * CELL_HGT + 40
-
-class App:
-    # Create and manage the tkinter interface.
-    def __init__(self):
-        self.network = None
-
-        # Make the main interface.
-        self.window = tk.Tk()
-        self.window.title('k-means digits')
-        self.window.protocol('WM_DELETE_WINDOW', self.kill_callback)
-        self.window.geometry(f'{WINDOW_WID}x{WINDOW_HGT}')
-
-        # Build the UI.
-        self.build_ui()
-
-        # Load the data.
-        self.load_data()
 
-        # Test K values between 3 and 20.
-        # (We want 10 results so there's probably
-        # no point using fewer than 10 clusters.)
-        self.test_ks(3, 20)
+# Stroke drawing settings. Mouse motion is drawn at most once every
+# FRAME_MS milliseconds, and a point is only added to the drawn line
+# if it is at least MIN_DRAW_DISTANCE pixels from the last point drawn
+# (use 0 to draw every point). Every point is still used to find the
+# touched cells.
+FRAME_MS = 16
+MIN_DRAW_DISTANCE = 2
+
+# The data to load. If IDX_IMAGES_FILE and IDX_LABELS_FILE are set,
+# load those IDX (MNIST format) files and shrink the images to a
+# NUM_ROWS x NUM_COLS grid. Otherwise load DATA_FILE.
+DATA_FILE = 'digit_data.txt'
+IDX_IMAGES_FILE = None
+IDX_LABELS_FILE = None
+
+# The part of the app that does not need a display. It loads
+# the data, finds good clusters, and classifies patterns.
+class KMeansDigits:
+    def __init__(self, data_file=DATA_FILE, idx_images_file=IDX_IMAGES_FILE,
+        idx_labels_file=IDX_LABELS_FILE, num_rows=NUM_ROWS, num_cols=NUM_COLS,
+        mini_batch_size=MINI_BATCH_SIZE, seed_init=SEED_INIT, num_workers=NUM_WORKERS):
+        self.k = 0
+        self.success_rate = 0
+        self.seeds = []
+        self.mini_batch_size = mini_batch_size
+        self.seed_init = seed_init
+        self.num_workers = num_workers
+
+        # The total number of iterations used to find clusters.
+        self.num_iterations = 0
+
+        # The data to load.
+        self.data_file = data_file
+        self.idx_images_file = idx_images_file
+        self.idx_labels_file = idx_labels_file
+        self.requested_rows = num_rows
+        self.requested_cols = num_cols
+
+    # Display a status message. The App shows it in its window.
+    def show_status(self, text):
+        pass
+
+    # Find good clusters for K values between min_k and max_k
+    # and report the results. Use the saved model if there is one
+    # for this data and these settings, unless retrain is True.
+    def train(self, min_k=3, max_k=20, retrain=False):
+        params = {
+            'min_k': min_k,
+            'max_k': max_k,
+            'num_trials': NUM_TRIALS,
+            'max_iterations': MAX_ITERATIONS,
+            'stop_distance': STOP_DISTANCE,
+        }
+        if self.mini_batch_size > 0:
+            params.update({
+                'mini_batch_size': self.mini_batch_size,
+                'mini_batch_smoothing': MINI_BATCH_SMOOTHING,
+                'mini_batch_stop_change': MINI_BATCH_STOP_CHANGE,
+                'mini_batch_patience': MINI_BATCH_PATIENCE,
+                'mini_batch_sample_points': MINI_BATCH_SAMPLE_POINTS,
+            })
+        if self.seed_init != 'random':
+            params['seed_init'] = self.seed_init
+        if self.num_workers > 0:
+            params['parallel_trials'] = True
+        if not retrain and self.load_trained_model(params):
+            print(f'Using the model saved in {MODEL_DIRECTORY}')
+        else:
+            # Test K values between min_k and max_k.
+            # (We want 10 results so there's probably
+            # no point using fewer than 10 clusters.)
+            self.test_ks(min_k, max_k)
+            self.save_trained_model(params)
 
         # Display the final results.
-        self.success_rate_value.set(f'K = {self.k}, Success Rate = {self.success_rate}%')
+        self.show_status(f'K = {self.k}, Success Rate = {self.success_rate}%')
         print(f'Final: K = {self.k}, Success Rate = {self.success_rate}%')
         print('Seeds:')
         for seed in self.seeds:
             print(f'    {seed.name}')
 
-        # Initially we have nothing to draw.
-        self.polyline = None
-        self.points = []
-
-        # Display the window.
-        self.window.focus_force()
-        self.window.mainloop()
-
     # Load the data and find good clusters.
     def load_data(self):
-        # Load the DataPoints.
-        with open('digit_data.txt', 'r') as f:
-            lines = f.readlines()
-            self.data_points = []
-            for line in lines:
-                self.data_points.append(DataPoint(line))
-
-    def redraw(self):
-        # Remove old polyline.
-        self.canvas.delete(self.polyline)
-        self.polyline = None
-
-        # Draw current points.
-        if len(self.points) > 1:
-            self.polyline = self.canvas.create_line(self.points, fill='black')
-
-    def build_ui(self):
-        # Make the drawing canvas.
-        canvas_wid = NUM_COLS * CELL_WID + 1
-        canvas_hgt = NUM_ROWS * CELL_HGT + 1
-        self.canvas = tk.Canvas(self.window, bg='white',
-            borderwidth=0, highlightthickness=0, relief=tk.SUNKEN, width=canvas_wid, height=canvas_hgt)
-        self.canvas.place(x=MARGIN, y=MARGIN)
-        self.canvas.bind('<Button-1>', self.start_draw)
-        self.canvas.bind('<ButtonRelease-1>', self.end_draw)
-
-        # Make grid lines.
-        for r in range(NUM_ROWS + 1):
-            self.canvas.create_line(0, r * CELL_HGT, canvas_wid, r * CELL_HGT, fill='lime')
-        for c in range(NUM_COLS + 1):
-            self.canvas.create_line(c * CELL_WID, 0, c * CELL_WID, canvas_hgt, fill='lime')
-
-        # Make a label to display success percentage.
-        self.success_rate_value = tk.StringVar()
-        self.success_rate_label = tk.Label(self.window, font=('Calibri 10 normal'), textvariable=self.success_rate_value)
-        self.success_rate_label.place(x=MARGIN, y=canvas_hgt + 2 * MARGIN)
-
-        # Make a big label to display results from the user drawing.
-        self.user_result_value = tk.StringVar()
-        self.user_result_label = tk.Label(self.window, font=('Calibri 100 normal'), textvariable=self.user_result_value)
-        self.user_result_label.place(x=canvas_wid + 2 * MARGIN, y=MARGIN)
-
-    def start_draw(self, event):
-        # Clear any previous result.
-        self.user_result_value.set('')
-
-        # Remove any previous drawing.
-        self.points = []
-        self.redraw()
-
-        self.canvas.bind('<B1-Motion>', self.save_point)
-
-    def end_draw(self, event):
-        self.canvas.unbind('<B1-Motion>')
-
-        # Evaluate the polyline.
-        self.evaluate_polyline()
-
-    def save_point(self, event):
-        self.points.append((event.x, event.y))
-        self.redraw()
-
-    def kill_callback(self):
-        self.window.destroy()
-
-    # See which seed is closest to the polyline.
-    def evaluate_polyline(self):
-        # Convert the polyline into a DataPoint.
-        data_point = self.polyline_to_data_point()
-
-        # Assign the DataPoint to a seed.
-        data_point.assign_seed(self.seeds)
-
-        # Display the result.
-        self.user_result_value.set(data_point.seed.name)
-        print(f'Digit: {data_point.seed.name}')
-
-    # Convert the polyline into a DataPoint.
-    def polyline_to_data_point(self):
-        # Convert the points into the cells that were touched.
-        touched = self.get_touched()
-
-        # Convert the touched cells to a string.
-        touched_string = self.touched_to_string(touched)
-
-        # Compose the DataPoint data string.
-        data_string = f'?: {touched_string}'
-
-        # Create the DataPoint.
-        return DataPoint(data_string)
-
-    # Convert the points into the cells that were touched.
-    def get_touched(self):
-        # Make a touched array holding 0s.
-        touched = []
-        for r in range(NUM_ROWS):
-            touched.append([0 for i in range(NUM_COLS)])
-
-        # Mark the touched cells.
-        for point in self.points:
-            r = int(point[1] / CELL_HGT)
-            c = int(point[0] / CELL_WID)
-            if r >= 0 and r < NUM_ROWS and c >= 0 and c < NUM_COLS:
-                touched[r][c] = 1
-
-        # Return the touched list.
-        return touched
-
-    # Return a string holding the touch values.
-    def touched_to_string(self, touched):
-        result = ''
-        for r in range(NUM_ROWS):
-            for c in range(NUM_COLS):
-                result += str(touched[r][c])
-        return result
+        # The array engine only needs the arrays, so the
+        # DataPoints are made when they are first used.
+        dataset = load_dataset(self.data_file, self.idx_images_file,
+            self.idx_labels_file, self.requested_rows, self.requested_cols)
+        self.num_rows = dataset.num_rows
+        self.num_cols = dataset.num_cols
+        self.data_points = dataset.data_points(DataPoint)
+        self.dataset = dataset
+        self.features = np.asarray(dataset.features)
+        self.names = np.asarray(dataset.labels)
+
+        # The full Lloyd trials in test_data shuffle these
+        # indexes instead of the DataPoints. They are made
+        # when first needed because mini-batch runs skip them.
+        self.point_indexes = None
+
+    # Load the seeds saved by save_trained_model.
+    # Return False if there is no saved model for this data and params.
+    def load_trained_model(self, params):
+        model = load_model(MODEL_DIRECTORY, model_key(self.dataset, params))
+        if model is None:
+            return False
+
+        # Rebuild the seeds from their names and properties.
+        seeds = []
+        for name, properties in zip(model['seed_names'].tolist(), model['seed_properties'].tolist()):
+            seeds.append(make_seed(name, properties))
+
+        self.k = model['k']
+        self.success_rate = model['success_rate']
+        self.seeds = seeds
+        return True
+
+    # Save the best seeds' names and properties.
+    def save_trained_model(self, params):
+        arrays = {
+            'seed_names': np.array([seed.name for seed in self.seeds]),
+            'seed_properties': np.array([seed.properties for seed in self.seeds], dtype=np.float64),
+        }
+        try:
+            save_model(MODEL_DIRECTORY, model_key(self.dataset, params), arrays,
+                {'k': self.k, 'success_rate': self.success_rate})
+        except OSError:
+            # We can still use the model if it cannot be saved.
+            pass
 
     #########################
     ### K-Means Functions ###
@@ -284,23 +537,25 @@ class App:
 
     # Test different values for K.
     # Save the best results in self.k, self.success_rate, and self.seeds.
-    # Test different values for K.
-    # Save the best results in self.k, self.success_rate, and self.seeds.
+    # They are updated as soon as each K is tested, so classify_data_point
+    # can use the best seeds so far while training continues.
     def test_ks(self, min_k, max_k):
         self.k = 0
         self.success_rate = 0
         self.seeds = []
 
         # Test K values between min_k and max_k.
-        for k in range(min_k, max_k + 1):
-            test_success_rate, test_seeds = self.test_data(k)
-
+        if self.num_workers > 0:
+            results = self.test_ks_in_parallel(min_k, max_k)
+        else:
+            results = ((k, *self.test_data(k)) for k in range(min_k, max_k + 1))
+        for k, test_success_rate, test_seeds in results:
             # If this is an improvement, update self.k.
             if self.success_rate < test_success_rate:
                 self.k = k
                 self.success_rate = test_success_rate
                 self.seeds = test_seeds
-
+                self.show_status(f'Training: K = {k}, Success Rate = {test_success_rate}%')
 
     # Test each of the data points with this value for K.
     # Save the best total distance, success rate, distance, and seeds list.
@@ -310,21 +565,33 @@ class App:
         best_seeds = []
 
         # Repeat several times to find a good set of clusters for this K.
-        NUM_TRIALS = 20  # Maybe use a bigger number like 100.
         for trial in range(NUM_TRIALS):
-            # Randomize the data.
-            random.shuffle(self.data_points)
-
-            # Divide the data into training and test points.
-            num_training = int(len(self.data_points) * 0.75)
-            training_points = self.data_points[:num_training]
-            test_points = self.data_points[num_training:]
-
-            # Find seeds.
-            MAX_ITERATIONS = 1000
-            STOP_DISTANCE = 1
-            test_success_rate, test_seeds = self.find_clusters(
-            k, training_points, test_points, MAX_ITERATIONS, STOP_DISTANCE)
+            if self.mini_batch_size > 0:
+                # Randomize the data without a list of every point.
+                test_success_rate, test_seeds = self.test_split(k, random_permutation(len(self.features)))
+            elif ARRAY_ENGINE:
+                # Randomize the data. Shuffling the indexes uses the random
+                # numbers the same way as shuffling the DataPoints.
+                if self.point_indexes is None:
+                    self.point_indexes = list(range(len(self.features)))
+                random.shuffle(self.point_indexes)
+
+                # Find seeds.
+                test_success_rate, test_seeds = self.test_split(k, self.point_indexes)
+            else:
+                # Divide the data into training and test points.
+                num_training = int(len(self.data_points) * 0.75)
+
+                # Randomize the data.
+                if not isinstance(self.data_points, list):
+                    self.data_points = list(self.data_points)
+                random.shuffle(self.data_points)
+                training_points = self.data_points[:num_training]
+                test_points = self.data_points[num_training:]
+
+                # Find seeds.
+                test_success_rate, test_seeds = self.find_clusters(
+                k, training_points, test_points, MAX_ITERATIONS, STOP_DISTANCE)
 
             # See if this is an improvement.
             if best_success_rate < test_success_rate:
@@ -336,6 +603,75 @@ class App:
         print(f'K = {k}, Success Rate = {best_success_rate:.2f}%')
         return best_success_rate, best_seeds
 
+    # Find seeds with the array engine, using the first 75% of the points
+    # in point_indexes for training and the rest for testing.
+    # Return the success rate and the seeds.
+    def test_split(self, k, point_indexes):
+        num_training = int(len(point_indexes) * 0.75)
+        training_indexes = point_indexes[:num_training]
+        test_indexes = point_indexes[num_training:]
+        if self.mini_batch_size > 0:
+            return self.find_mini_batch_clusters(k, training_indexes, test_indexes,
+                self.mini_batch_size, MAX_ITERATIONS)
+
+        training_features = self.features[training_indexes]
+        training_names = self.names[training_indexes]
+        test_features = self.features[test_indexes]
+        test_names = self.names[test_indexes]
+        return self.find_array_clusters(k,
+            training_features, training_names, test_features, test_names,
+            MAX_ITERATIONS, STOP_DISTANCE)
+
+    # Like calling test_data for each K, but run the trials as separate
+    # jobs in a pool of self.num_workers processes. Each job gets its
+    # own random numbers (see run_trial), so the results depend only on
+    # the master seed picked here and not on the number of workers.
+    # Yield each K with its best success rate and seeds, in order of K.
+    def test_ks_in_parallel(self, min_k, max_k):
+        master_seed = random.getrandbits(64)
+        options = {'mini_batch_size': self.mini_batch_size, 'seed_init': self.seed_init}
+
+        # Use new processes rather than forking this one,
+        # which may be running the tkinter window.
+        with ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=start_trial_worker, initargs=(options, self.features, self.names)) as executor:
+            jobs = {}
+            for k in range(min_k, max_k + 1):
+                for trial in range(NUM_TRIALS):
+                    jobs[k, trial] = executor.submit(run_trial, master_seed, k, trial)
+
+            # Pick the best trial for each K in trial order, like test_data.
+            for k in range(min_k, max_k + 1):
+                best_success_rate = 0
+                best_seeds = []
+                for trial in range(NUM_TRIALS):
+                    test_success_rate, seed_names, seed_properties, num_iterations = jobs[k, trial].result()
+                    self.num_iterations += num_iterations
+                    if best_success_rate < test_success_rate:
+                        best_success_rate = test_success_rate
+                        best_seeds = [make_seed(name, properties) for name, properties in zip(seed_names, seed_properties)]
+
+                print(f'K = {k}, Success Rate = {best_success_rate:.2f}%')
+                yield k, best_success_rate, best_seeds
+
+    # Run one trial for test_ks_in_parallel. Instead of shuffling the
+    # shared self.point_indexes, the trial shuffles its own list of
+    # indexes. The random numbers are seeded from master_seed, k, and
+    # trial, so they are the same whichever process runs the trial.
+    # Return the success rate, the seeds' names and properties, and
+    # the number of iterations used.
+    def run_trial(self, master_seed, k, trial):
+        random.seed(f'{master_seed}:{k}:{trial}')
+        if self.mini_batch_size > 0:
+            point_indexes = random_permutation(len(self.features))
+        else:
+            point_indexes = list(range(len(self.features)))
+            random.shuffle(point_indexes)
+
+        self.num_iterations = 0
+        test_success_rate, test_seeds = self.test_split(k, point_indexes)
+        return (test_success_rate, [seed.name for seed in test_seeds],
+            [seed.properties for seed in test_seeds], self.num_iterations)
 
     # Assign points to their nearest seeds.
     def assign_points_to_seeds(self, data_points, seeds):
@@ -372,10 +708,22 @@ class App:
     #     The list of seeds.
     def find_clusters(self, k, training_points, test_points,
                       max_iterations=1000, stop_distance=1):
+        if ARRAY_ENGINE:
+            return self.find_array_clusters(k,
+                np.array([point.properties for point in training_points]),
+                np.array([point.name for point in training_points]),
+                np.array([point.properties for point in test_points]),
+                np.array([point.name for point in test_points]),
+                max_iterations, stop_distance)
 
         # Make k initial seeds.
         seeds = []
-        for seed in random.sample(training_points, k):
+        if self.seed_init == 'random':
+            initial_points = random.sample(training_points, k)
+        else:
+            training_features = np.array([point.properties for point in training_points])
+            initial_points = [training_points[i] for i in self.seed_indexes(k, training_features)]
+        for seed in initial_points:
             # Make a copy of this data point so
             # we don't mess up the original.
             seeds.append(DataPoint(seed.data_string))
@@ -387,6 +735,7 @@ class App:
             # Move the seeds to their centroids.
             if self.reposition_seeds(training_points, seeds) < stop_distance:
                 break
+        self.num_iterations += iteration + 1
 
         # Assign likely names to seeds.
         for seed in seeds:
@@ -399,10 +748,410 @@ class App:
         # Return the results.
         return success_rate, seeds
 
+    # Like find_clusters but for points stored as arrays: one row of
+    # properties per point in training_features and test_features and
+    # the points' names in training_names and test_names. Each iteration
+    # assigns all of the points at once and then moves all of the seeds
+    # with one grouped sum. The seeds are returned as DataPoints.
+    def find_array_clusters(self, k, training_features, training_names,
+            test_features, test_names, max_iterations=1000, stop_distance=1):
+        # Make k initial seeds.
+        centroids = training_features[self.seed_indexes(k, training_features)].astype(np.float64)
+
+        # Repeat until things stabilize.
+        assignment = BoundedAssignment(training_features)
+        for iteration in range(max_iterations):
+            if BOUNDED_ASSIGNMENT:
+                labels = assignment.assign(centroids)
+                if PRINT_SKIPPED:
+                    total = len(training_features) * k
+                    print(f'K = {k}, Iteration {iteration}: skipped {assignment.skipped[-1]} of {total} distances')
+            else:
+                labels = nearest_centroids(training_features, centroids)
+            centroids, max_move = move_centroids(training_features, labels, centroids)
+            if max_move < stop_distance:
+                break
+        self.num_iterations += iteration + 1
+
+        # Assign likely names to seeds.
+        seed_names = centroid_names(labels, training_names, k)
+        return self.array_results(centroids, seed_names, test_features, test_names)
+
+    # Like find_array_clusters, but each iteration moves the seeds toward
+    # a random batch of batch_size training points (mini-batch k-means).
+    # Each seed moves by a learning rate of 1 / (the number of batch
+    # points it has been given so far) toward each of its batch points,
+    # so it stays at the average of all of them.
+    # training_indexes and test_indexes hold the rows of self.features
+    # to use in random order, so their first rows are random samples.
+    # Only the batches and samples are copied out of self.features.
+    def find_mini_batch_clusters(self, k, training_indexes, test_indexes,
+            batch_size, max_iterations=1000):
+        # Make k initial seeds from a sample of the training points.
+        num_training = len(training_indexes)
+        sample = training_indexes[:MINI_BATCH_SAMPLE_POINTS]
+        sample_features = self.features[sample]
+        centroids = sample_features[self.seed_indexes(k, sample_features)].astype(np.float64)
+        seed_counts = np.zeros(k)
+
+        smoothed_distance = None
+        best_distance = math.inf
+        num_without_improvement = 0
+        for iteration in range(max_iterations):
+            # Assign a random batch of points to their nearest seeds.
+            batch_rows = random.sample(range(num_training), min(batch_size, num_training))
+            batch = self.features[training_indexes[batch_rows]]
+            distances = centroid_distances(batch, centroids)
+            labels = np.argmin(distances, axis=1)
+
+            # Move each seed toward its batch points.
+            batch_counts = np.bincount(labels, minlength=k)
+            sums = np.zeros(centroids.shape)
+            np.add.at(sums, labels, batch)
+            assigned = batch_counts > 0
+            seed_counts[assigned] += batch_counts[assigned]
+            centroids[assigned] += (sums[assigned] - batch_counts[assigned, None] * centroids[assigned]) / seed_counts[assigned, None]
+
+            # Stop when the smoothed average distance stops improving.
+            batch_distance = distances[np.arange(len(batch)), labels].mean()
+            if smoothed_distance is None:
+                smoothed_distance = batch_distance
+            else:
+                smoothed_distance += MINI_BATCH_SMOOTHING * (batch_distance - smoothed_distance)
+            if smoothed_distance < best_distance - MINI_BATCH_STOP_CHANGE:
+                best_distance = smoothed_distance
+                num_without_improvement = 0
+            else:
+                num_without_improvement += 1
+                if num_without_improvement >= MINI_BATCH_PATIENCE:
+                    break
+        self.num_iterations += iteration + 1
+
+        # Assign likely names to seeds using the sample of training points.
+        labels = nearest_centroids(sample_features, centroids)
+        seed_names = centroid_names(labels, self.names[sample], k)
+
+        # Score the seeds on a sample of the test points.
+        test_sample = test_indexes[:MINI_BATCH_SAMPLE_POINTS]
+        return self.array_results(centroids, seed_names, self.features[test_sample], self.names[test_sample])
+
+    # Return the indexes of the training points to use as the first k seeds.
+    # Sampling the indexes picks the same points as sampling the list of points.
+    def seed_indexes(self, k, training_features):
+        if self.seed_init == 'k-means++':
+            return kmeans_plus_plus_indexes(training_features, k)
+        if self.seed_init == 'k-means||':
+            return kmeans_parallel_indexes(training_features, k)
+        return random.sample(range(len(training_features)), k)
+
+    # Calculate the success rate percentage for seeds at the given
+    # centroids with the given names. Return it and the seeds.
+    def array_results(self, centroids, seed_names, test_features, test_names):
+        num_correct = np.count_nonzero(seed_names[nearest_centroids(test_features, centroids)] == test_names)
+        success_rate = int(100 * num_correct / len(test_features))
+
+        seeds = [make_seed(name, properties) for name, properties in zip(seed_names.tolist(), centroids.tolist())]
+        return success_rate, seeds
+
+    # Return True if there are seeds to classify with. During
+    # training these may be the best seeds found so far.
+    def has_model(self):
+        return len(self.seeds) > 0
+
+    # Assign a DataPoint to its closest seed and return the seed's name.
+    def classify_data_point(self, data_point):
+        data_point.assign_seed(self.seeds)
+        return data_point.seed.name
+
+    # Return the name of the seed closest to a string of 0s and 1s.
+    def classify_pattern(self, zeros_and_ones):
+        return self.classify_data_point(DataPoint(f'?: {zeros_and_ones}'))
+
+    # Return an array holding the name of the seed closest to each row of 0s and 1s.
+    # The distances are added up one property at a time, in the same order
+    # as DataPoint.distance, and ties go to the first seed like assign_seed,
+    # so the results match classify_data_point exactly.
+    def classify_patterns(self, features):
+        seed_properties = np.array([seed.properties for seed in self.seeds], dtype=np.float64)
+        seed_names = np.array([seed.name for seed in self.seeds])
+        return seed_names[nearest_centroids(np.asarray(features), seed_properties)]
+
+# The KMeansDigits that runs trials in a worker process of
+# test_ks_in_parallel. start_trial_worker gives it the data once,
+# so each job only needs its master seed, K, and trial number.
+trial_worker = None
+
+def start_trial_worker(options, features, names):
+    global trial_worker
+    trial_worker = KMeansDigits(**options)
+    trial_worker.features = features
+    trial_worker.names = names
+
+def run_trial(master_seed, k, trial):
+    return trial_worker.run_trial(master_seed, k, trial)
+
+
+# In[ ]:
+
+
+# The main App class.
+class App(KMeansDigits):
+    # Create and manage the tkinter interface.
+    def __init__(self, min_k=3, max_k=20, retrain=False, **data_options):
+        KMeansDigits.__init__(self, **data_options)
+        self.network = None
+
+        # Import tkinter here so the rest of the module works without a display.
+        global tk
+        import tkinter as tk
+
+        # Make the main interface.
+        self.window = tk.Tk()
+        self.window.title('k-means digits')
+        self.window.protocol('WM_DELETE_WINDOW', self.kill_callback)
+
+        # Load the data. This tells us the size of the grid.
+        self.load_data()
+        self.window.geometry(f'{self.num_cols * CELL_WID + 100}x{self.num_rows * CELL_HGT + 40}')
+
+        # Build the UI.
+        self.build_ui()
+
+        # Initially we have nothing to draw.
+        self.polyline = None
+        self.points = []
+        self.drawn_points = []
+        self.redraw_pending = None
+
+        # Find good clusters in the background so the window stays responsive.
+        self.start_training(min_k, max_k, retrain)
+
+        # Display the window.
+        self.window.focus_force()
+        self.window.mainloop()
+
+    # Start training in a worker thread. Its status messages are
+    # passed to the window by poll_training.
+    def start_training(self, min_k, max_k, retrain):
+        self.status_queue = queue.Queue()
+        self.training_thread = threading.Thread(
+            target=self.train, args=(min_k, max_k, retrain), daemon=True)
+        self.training_thread.start()
+        self.window.after(TRAINING_POLL_MS, self.poll_training)
+
+    # Display any status messages from the training thread.
+    # Keep checking until the thread finishes.
+    def poll_training(self):
+        # See if training is running before taking the messages
+        # so we don't miss any that it sends just before it stops.
+        still_training = self.training_thread.is_alive()
+        while not self.status_queue.empty():
+            self.success_rate_value.set(self.status_queue.get())
+        if still_training:
+            self.window.after(TRAINING_POLL_MS, self.poll_training)
+
+    # Display a status message below the drawing. This may be called by
+    # the training thread, which must not touch tkinter, so just queue it.
+    def show_status(self, text):
+        self.status_queue.put(text)
+
+    # Draw the stroke's points. The polyline is made once per stroke,
+    # and after that its coordinates are updated in place.
+    def redraw(self):
+        self.redraw_pending = None
+        if len(self.drawn_points) < 2:
+            return
+        if self.polyline is None:
+            self.polyline = self.canvas.create_line(self.drawn_points, fill='black')
+        else:
+            self.canvas.coords(self.polyline, self.drawn_points)
+
+    # Redraw at the next frame. Motion events that
+    # arrive before then are all drawn at once.
+    def schedule_redraw(self):
+        if self.redraw_pending is None:
+            self.redraw_pending = self.window.after(FRAME_MS, self.redraw)
+
+    # Draw any points that are waiting for the next frame now.
+    def flush_redraw(self):
+        if self.redraw_pending is not None:
+            self.window.after_cancel(self.redraw_pending)
+            self.redraw()
+
+    # Remove the stroke and forget its points.
+    def clear_drawing(self):
+        if self.redraw_pending is not None:
+            self.window.after_cancel(self.redraw_pending)
+            self.redraw_pending = None
+        if self.polyline is not None:
+            self.canvas.delete(self.polyline)
+            self.polyline = None
+        self.points = []
+        self.drawn_points = []
+
+    def build_ui(self):
+        # Make the drawing canvas.
+        canvas_wid = self.num_cols * CELL_WID + 1
+        canvas_hgt = self.num_rows * CELL_HGT + 1
+        self.canvas = tk.Canvas(self.window, bg='white',
+            borderwidth=0, highlightthickness=0, relief=tk.SUNKEN, width=canvas_wid, height=canvas_hgt)
+        self.canvas.place(x=MARGIN, y=MARGIN)
+        self.canvas.bind('<Button-1>', self.start_draw)
+        self.canvas.bind('<ButtonRelease-1>', self.end_draw)
+
+        # Make grid lines.
+        for r in range(self.num_rows + 1):
+            self.canvas.create_line(0, r * CELL_HGT, canvas_wid, r * CELL_HGT, fill='lime')
+        for c in range(self.num_cols + 1):
+            self.canvas.create_line(c * CELL_WID, 0, c * CELL_WID, canvas_hgt, fill='lime')
+
+        # Make a label to display success percentage.
+        self.success_rate_value = tk.StringVar()
+        self.success_rate_label = tk.Label(self.window, font=('Calibri 10 normal'), textvariable=self.success_rate_value)
+        self.success_rate_label.place(x=MARGIN, y=canvas_hgt + 2 * MARGIN)
+
+        # Make a big label to display results from the user drawing.
+        self.user_result_value = tk.StringVar()
+        self.user_result_label = tk.Label(self.window, font=('Calibri 100 normal'), textvariable=self.user_result_value)
+        self.user_result_label.place(x=canvas_wid + 2 * MARGIN, y=MARGIN)
+
+    def start_draw(self, event):
+        # Clear any previous result.
+        self.user_result_value.set('')
+
+        # Remove any previous drawing.
+        self.clear_drawing()
+
+        self.canvas.bind('<B1-Motion>', self.save_point)
+
+    def end_draw(self, event):
+        self.canvas.unbind('<B1-Motion>')
+        self.flush_redraw()
+
+        # Evaluate the polyline.
+        self.evaluate_polyline()
+
+    def save_point(self, event):
+        self.points.append((event.x, event.y))
+
+        # Draw the point if it is far enough from the last one drawn.
+        if len(self.drawn_points) == 0 or \
+            (event.x - self.drawn_points[-1][0]) ** 2 + \
+            (event.y - self.drawn_points[-1][1]) ** 2 >= MIN_DRAW_DISTANCE ** 2:
+            self.drawn_points.append((event.x, event.y))
+            self.schedule_redraw()
+
+    def kill_callback(self):
+        self.window.destroy()
+
+    # See which seed is closest to the polyline.
+    def evaluate_polyline(self):
+        # Wait until training has found some seeds.
+        if not self.has_model():
+            self.user_result_value.set('?')
+            print('Digit: ? (still training)')
+            return
+
+        # Convert the polyline into a DataPoint.
+        data_point = self.polyline_to_data_point()
+
+        # Assign the DataPoint to a seed. These are the best seeds found so far.
+        self.classify_data_point(data_point)
+
+        # Display the result.
+        self.user_result_value.set(data_point.seed.name)
+        print(f'Digit: {data_point.seed.name}')
+
+    # Convert the polyline into a DataPoint.
+    def polyline_to_data_point(self):
+        # Convert the points into the cells that were touched.
+        touched = self.get_touched()
+
+        # Convert the touched cells to a string.
+        touched_string = self.touched_to_string(touched)
+
+        # Compose the DataPoint data string.
+        data_string = f'?: {touched_string}'
+
+        # Create the DataPoint.
+        return DataPoint(data_string)
+
+    # Convert the points into the cells that were touched.
+    def get_touched(self):
+        # Make a touched array holding 0s.
+        touched = []
+        for r in range(self.num_rows):
+            touched.append([0 for i in range(self.num_cols)])
+
+        # Mark the touched cells.
+        for point in self.points:
+            r = int(point[1] / CELL_HGT)
+            c = int(point[0] / CELL_WID)
+            if r >= 0 and r < self.num_rows and c >= 0 and c < self.num_cols:
+                touched[r][c] = 1
+
+        # Return the touched list.
+        return touched
+
+    # Return a string holding the touch values.
+    def touched_to_string(self, touched):
+        result = ''
+        for r in range(self.num_rows):
+            for c in range(self.num_cols):
+                result += str(touched[r][c])
+        return result
+
+
 # In[ ]:
 
 
-App()
+# Run the App, or with --headless, just train and print the results.
+def main():
+    parser = argparse.ArgumentParser(description='Use k-means clusters to classify drawn digits.')
+    add_data_arguments(parser, DATA_FILE, NUM_ROWS, NUM_COLS)
+    parser.add_argument('--headless', action='store_true',
+        help='train and print the results without opening a window')
+    parser.add_argument('--min-k', type=int, default=3, help='smallest K to test')
+    parser.add_argument('--max-k', type=int, default=20, help='largest K to test')
+    parser.add_argument('--seed', type=int, help='random seed for repeatable runs')
+    parser.add_argument('--mini-batch', type=int, default=MINI_BATCH_SIZE, metavar='SIZE',
+        help='move the seeds toward random batches of SIZE points (0 uses all points)')
+    parser.add_argument('--init', choices=SEED_INITS, default=SEED_INIT,
+        help=f'how to pick the first seeds (default {SEED_INIT})')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS,
+        help='run the trials in this many processes (0 runs them in order in this one)')
+    parser.add_argument('--retrain', action='store_true',
+        help=f'train even if {MODEL_DIRECTORY} holds a model for this data')
+    parser.add_argument('--classify', nargs='+', default=[], metavar='PATTERN',
+        help='strings of 0s and 1s to classify after training (with --headless)')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    if not args.headless:
+        App(args.min_k, args.max_k, args.retrain, mini_batch_size=args.mini_batch, seed_init=args.init,
+        num_workers=args.workers, **data_options(args))
+        return
+
+    k_means_digits = KMeansDigits(mini_batch_size=args.mini_batch, seed_init=args.init,
+        num_workers=args.workers, **data_options(args))
+    start_time = time.perf_counter()
+    k_means_digits.load_data()
+    print(f'Loaded {len(k_means_digits.data_points)} digits in {time.perf_counter() - start_time:.3f} seconds')
+
+    start_time = time.perf_counter()
+    k_means_digits.train(args.min_k, args.max_k, args.retrain)
+    print(f'Trained in {time.perf_counter() - start_time:.3f} seconds')
+
+    for pattern in args.classify:
+        start_time = time.perf_counter()
+        name = k_means_digits.classify_pattern(pattern)
+        print(f'{pattern}: {name} ({1000 * (time.perf_counter() - start_time):.3f} ms)')
+
+
+if __name__ == '__main__':
+    main()
 
 
 # In[ ]:
@@ -34,6 +34,7 @@ def make_field(parent, label_width, label_text, entry_width, entry_default):
 # In[2]:
 
 
+import heapq
 import math
 
 class DataPoint:
@@ -48,8 +49,11 @@ class DataPoint:
         return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2)     
 
     def knn(self, data_points, k):
-        # A. Sort the data points by their distances from the new point self.
-        sorted_data_points = sorted(data_points, key=self.distance)
+        # A. Find the data points closest to the new point self.
+        # We only need k of them (plus self if it is in the list),
+        # so keep a bounded heap instead of sorting every point.
+        # nsmallest breaks ties the same way a stable sort does.
+        sorted_data_points = heapq.nsmallest(k + 1, data_points, key=self.distance)
 
         # B. Count up to k votes.
         votes = {}  # a. Make a dictionary named votes.
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # K-Nearest Neighbors Digits Benchmark
+# Time nearest neighbor queries as the reference set grows.
+# Usage: python knn_digits_benchmark.py [size ...]
+
+
+import random
+import sys
+import time
+
+from knn_digits_starter_solution import DataPoint, BitSlicedDataset, MultiIndexHash
+
+# Reference set sizes to test.
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# Number of queries to time for each size.
+NUM_QUERIES = 20
+
+# Number of neighbors to find.
+K = 5
+
+# Number of cells to flip when making a noisy copy of a digit.
+NUM_FLIPS = 3
+
+# Make num_points noisy copies of the digits in lines.
+def make_data_points(lines, num_points, rng):
+    data_points = []
+    for i in range(num_points):
+        fields = rng.choice(lines).split(' ')
+        cells = list(fields[1].strip())
+        for c in rng.sample(range(len(cells)), NUM_FLIPS):
+            cells[c] = '1' if cells[c] == '0' else '0'
+        data_points.append(DataPoint(f'{fields[0]} {"".join(cells)}'))
+    return data_points
+
+# Find each query's neighbors.
+# Return the results and the average time per query in milliseconds.
+def time_queries(data_points, queries):
+    start_time = time.perf_counter()
+    results = [query.nearest(data_points, K) for query in queries]
+    elapsed = time.perf_counter() - start_time
+    return results, 1000 * elapsed / len(queries)
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    rng = random.Random(0)
+    with open('digit_data.txt', 'r') as f:
+        lines = f.readlines()
+
+    print(f'{"Size":>10} {"Engine":>10} {"Build ms":>10} {"Query ms":>10}')
+    for size in sizes:
+        data_points = make_data_points(lines, size, rng)
+        queries = make_data_points(lines, NUM_QUERIES, rng)
+
+        # Time a linear search to get the exact results.
+        expected, query_ms = time_queries(data_points, queries)
+        print(f'{size:>10} {"list":>10} {0:>10.1f} {query_ms:>10.3f}')
+
+        # Time each index and make sure it agrees with the linear search.
+        for name, make_index in [('bitsliced', BitSlicedDataset), ('mih', MultiIndexHash)]:
+            start_time = time.perf_counter()
+            index = make_index(data_points)
+            build_ms = 1000 * (time.perf_counter() - start_time)
+
+            results, query_ms = time_queries(index, queries)
+            for result, expected_result in zip(results, expected):
+                if [id(dp) for dp in result] != [id(dp) for dp in expected_result]:
+                    raise ValueError(f'{name} does not match the linear search')
+            print(f'{size:>10} {name:>10} {build_ms:>10.1f} {query_ms:>10.3f}')
+
+
+if __name__ == '__main__':
+    main()
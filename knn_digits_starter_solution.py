@@ -7,7 +7,18 @@
 # In[1]:
 
 
+import heapq
+import itertools
 import math
+import random
+import numpy as np
+
+# Return the number of 1 bits in a non-negative int.
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(value):
+        return bin(value).count('1')
 
 class DataPoint:
     # The data_string parameter is a string holding the digit, 0s, and 1s
@@ -23,42 +34,637 @@ class DataPoint:
         for ch in self.zeros_and_ones:
             self.properties.append(int(ch))
 
+        # Pack the 0s and 1s into a single int, one bit per cell,
+        # so we can compare two digits with a single XOR.
+        self.bits = int(self.zeros_and_ones, 2)
+
     def distance(self, other):
         if len(self.properties) != len(other.properties):
             raise ValueError("DataPoints must have the same number of properties")
 
-        return math.sqrt(sum((self.properties[i] - other.properties[i])**2 for i in range(len(self.properties))))
+        # The properties are all 0 or 1, so the squared differences
+        # are just the number of cells where the two points differ.
+        return math.sqrt(self.hamming_distance(other))
+
+    # Return the number of cells where this point and another one differ.
+    # This orders points exactly the same way distance does, but it
+    # skips the square root so it is cheap enough to call in knn.
+    def hamming_distance(self, other):
+        return popcount(self.bits ^ other.bits)
     
     
+    # Return the count data points closest to this one, nearest first.
+    # Points at the same distance keep their order in data_points.
+    def nearest(self, data_points, count):
+        # Search structures such as BitSlicedDataset know how to
+        # find the nearest points themselves.
+        if hasattr(data_points, 'nearest'):
+            return data_points.nearest(self, count)
+
+        # Keep only the count closest points in a heap instead of
+        # sorting all of them. nsmallest breaks ties the same way
+        # a stable sort does.
+        return heapq.nsmallest(count, data_points, key=self.hamming_distance)
+
     # Use K nearest neighbors to set the data point's name.
     def knn(self, data_points, k):
-        # Sort the data points by distance this one.
-        sorted_data_points = sorted(data_points, key=lambda other: self.distance(other))
-
-        # Count the first k votes.
-        votes = {}
-        num_votes = 0
-        for point in sorted_data_points:
-            # Add 1 to this name's vote count.
-            if point.name in votes:
-                votes[point.name] += 1
+        self.name = vote(self.nearest(data_points, k))
+
+
+# Return the name with the most votes from these neighbors.
+# If there is a tie, the name that appears first wins.
+def vote(neighbors):
+    # Count the votes.
+    votes = {}
+    for point in neighbors:
+        # Add 1 to this name's vote count.
+        if point.name in votes:
+            votes[point.name] += 1
+        else:
+            votes[point.name] = 1
+
+    # See which name had the most votes.
+    return max(votes, key=lambda name:votes[name])
+
+
+# A transposed copy of a list of DataPoints.
+# Instead of storing one int per point, this stores one big int per
+# grid cell. Bit i of columns[c] holds cell c of data point i, so a
+# query can be compared to every point at once with a few big int
+# operations per cell.
+class BitSlicedDataset:
+    def __init__(self, data_points):
+        self.data_points = list(data_points)
+        self.all_ones = (1 << len(self.data_points)) - 1
+
+        # Build each column from a string of the points' cell values.
+        # The last point goes first so point i ends up in bit i.
+        self.columns = []
+        if len(self.data_points) > 0:
+            for c in range(len(self.data_points[0].properties)):
+                column_string = ''.join(dp.zeros_and_ones[c] for dp in reversed(self.data_points))
+                self.columns.append(int(column_string, 2))
+
+    # Add a point after the existing ones.
+    def add(self, data_point):
+        bit = 1 << len(self.data_points)
+        self.data_points.append(data_point)
+        self.all_ones |= bit
+        if len(self.columns) == 0:
+            self.columns = [0] * len(data_point.properties)
+        for c in range(len(self.columns)):
+            if data_point.properties[c]:
+                self.columns[c] |= bit
+
+    # Return the Hamming distances from data_point to every point as a
+    # list of bit planes. Bit i of planes[b] is bit b of point i's distance.
+    def distance_planes(self, data_point):
+        planes = []
+        for c in range(len(self.columns)):
+            # Find the points that differ from data_point in this cell.
+            diff = self.columns[c]
+            if data_point.properties[c]:
+                diff ^= self.all_ones
+
+            # Add 1 to those points' distances with a ripple carry adder.
+            carry = diff
+            for b in range(len(planes)):
+                if not carry: break
+                planes[b], carry = planes[b] ^ carry, planes[b] & carry
+            if carry:
+                planes.append(carry)
+        return planes
+
+    # Return the count points closest to data_point, nearest first.
+    # Points at the same distance keep their order in data_points.
+    def nearest(self, data_point, count):
+        planes = self.distance_planes(data_point)
+
+        result = []
+        for distance in range(1 << len(planes)):
+            # Select the points at exactly this distance.
+            mask = self.all_ones
+            for b in range(len(planes)):
+                if distance >> b & 1:
+                    mask &= planes[b]
+                else:
+                    mask &= ~planes[b]
+
+            # Add them to the result in index order.
+            while mask and len(result) < count:
+                lowest_bit = mask & -mask
+                result.append(self.data_points[lowest_bit.bit_length() - 1])
+                mask ^= lowest_bit
+
+            if len(result) >= count: break
+        return result
+
+
+# An exact nearest neighbor index for Hamming distance that uses
+# multi-index hashing. Each packed point is cut into substrings of
+# substring_bits bits, and each substring gets its own hash table.
+# If two points differ in d cells, then at least one of their m
+# substrings differs in at most d // m cells. That lets a query
+# look up only the table entries near its own substrings.
+# If substring_bits is None, use about log2(number of points) bits.
+#
+# A query still compares itself to every point that shares a probed
+# substring, and points at the same distance must all be found to keep
+# the linear search's order. Digits share most of their cells, and 48
+# cells are too few for the substrings to tell points apart, so on this
+# data the cost grows about linearly and a query is slower than a
+# BitSlicedDataset search. It is kept for comparison, not as the default.
+class MultiIndexHash:
+    def __init__(self, data_points, substring_bits=None):
+        self.data_points = list(data_points)
+
+        # Find the bit position and width of each substring.
+        num_cells = 0
+        if len(self.data_points) > 0:
+            num_cells = len(self.data_points[0].properties)
+        if substring_bits is None:
+            substring_bits = max(1, min(num_cells, round(math.log2(len(self.data_points) + 1))))
+        self.substrings = []
+        for start in range(0, num_cells, substring_bits):
+            width = min(substring_bits, num_cells - start)
+            self.substrings.append((start, width))
+
+        # Add each point's index to the table for each of its substrings.
+        self.tables = [{} for substring in self.substrings]
+        for i, dp in enumerate(self.data_points):
+            self.add_to_tables(dp, i)
+
+    # Add a point's index to the table for each of its substrings.
+    def add_to_tables(self, data_point, i):
+        for table, (start, width) in zip(self.tables, self.substrings):
+            key = data_point.bits >> start & ((1 << width) - 1)
+            if key in table:
+                table[key].append(i)
+            else:
+                table[key] = [i]
+
+    # Add a point after the existing ones. The substrings keep their
+    # widths, so add many points by building a new index instead.
+    def add(self, data_point):
+        self.data_points.append(data_point)
+        self.add_to_tables(data_point, len(self.data_points) - 1)
+
+    # Return the count points closest to data_point, nearest first.
+    # Points at the same distance keep their order in data_points,
+    # so the result is the same as a linear search.
+    def nearest(self, data_point, count):
+        count = min(count, len(self.data_points))
+        if count <= 0: return []
+
+        # Search the tables for keys 0, 1, 2, ... bits away from the
+        # query's substrings. found holds (distance, index) pairs.
+        found = []
+        seen = set()
+        max_width = max(width for start, width in self.substrings)
+        for radius in range(max_width + 1):
+            for table, (start, width) in zip(self.tables, self.substrings):
+                if radius > width: continue
+                query_key = data_point.bits >> start & ((1 << width) - 1)
+                for flips in itertools.combinations(range(width), radius):
+                    key = query_key
+                    for bit in flips:
+                        key ^= 1 << bit
+                    for i in table.get(key, ()):
+                        if i not in seen:
+                            seen.add(i)
+                            found.append((data_point.hamming_distance(self.data_points[i]), i))
+
+            # Every point within this distance has been found.
+            # If the count'th closest point so far is that close,
+            # nothing we have not seen yet can beat it.
+            complete_distance = len(self.substrings) * (radius + 1) - 1
+            if len(found) >= count:
+                found.sort()
+                if found[count - 1][0] <= complete_distance:
+                    break
+
+        found.sort()
+        return [self.data_points[i] for distance, i in found[:count]]
+
+
+# The data points with identical 0s and 1s collapsed together.
+# features holds the data points' 0s and 1s, one row per point.
+# indexes[u] is the index of the first data point with unique pattern u,
+# pattern_numbers[i] is the number of data point i's pattern,
+# and members[u] lists the indexes of every point with pattern u.
+class UniquePatternSet:
+    def __init__(self, data_points, features):
+        self.data_points = data_points
+        self.patterns = None
+        self.pattern_lookup = None
+
+        # Pack each row into bytes so np.unique can compare whole rows.
+        packed = np.ascontiguousarray(np.packbits(features, axis=1))
+        keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+        unique_keys, first_indexes, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+        # Number the patterns in the order they first appear.
+        order = np.argsort(first_indexes)
+        renumber = np.empty_like(order)
+        renumber[order] = np.arange(len(order))
+        self.indexes = first_indexes[order]
+        self.pattern_numbers = renumber[inverse.ravel()]
+        self.packed_patterns = packed[self.indexes]
+
+        # List the members of each pattern in index order.
+        members = np.argsort(self.pattern_numbers, kind='stable')
+        ends = np.cumsum(np.bincount(self.pattern_numbers, minlength=len(self.indexes)))
+        self.members = [block.tolist() for block in np.split(members, ends[:-1])]
+
+    # Add a point after the existing ones. features is its row of 0s and 1s.
+    # Return the number of its pattern, which is new if it equals len(indexes) - 1.
+    def add(self, data_point, features):
+        # Map the packed patterns to their numbers the first time.
+        if self.pattern_lookup is None:
+            self.pattern_lookup = {pattern.tobytes(): u for u, pattern in enumerate(self.packed_patterns)}
+
+        i = len(self.pattern_numbers)
+        key = np.packbits(np.asarray(features, dtype=np.uint8)).tobytes()
+        number = self.pattern_lookup.get(key)
+        if number is None:
+            number = len(self.indexes)
+            self.pattern_lookup[key] = number
+            self.indexes = np.append(self.indexes, i)
+            self.members.append([i])
+            if self.patterns is not None:
+                self.patterns.append(data_point.bits)
+        else:
+            self.members[number].append(i)
+        self.pattern_numbers = np.append(self.pattern_numbers, number)
+        return number
+
+    # Return the count points closest to data_point, nearest first.
+    # Only the unique patterns are compared to data_point. The points
+    # at each distance are then put back in index order, so the result
+    # is the same as a linear search over all of the points.
+    def nearest(self, data_point, count):
+        # Pack the unique patterns the first time they are needed.
+        if self.patterns is None:
+            self.patterns = [self.data_points[i].bits for i in self.indexes]
+
+        # Group the unique patterns by distance.
+        levels = {}
+        for u, pattern in enumerate(self.patterns):
+            distance = popcount(data_point.bits ^ pattern)
+            if distance in levels:
+                levels[distance].append(u)
             else:
-                votes[point.name] = 1
+                levels[distance] = [u]
 
-            # Count up to k votes.
-            num_votes += 1
-            if num_votes >= k: break
+        result = []
+        for distance in sorted(levels):
+            for i in heapq.merge(*(self.members[u] for u in levels[distance])):
+                if len(result) >= count: return result
+                result.append(self.data_points[i])
+        return result
 
-        # See which name had the most votes.
-        self.name = max(votes, key=lambda name:votes[name])
 
+# An approximate nearest neighbor index that uses bit sampling
+# locality-sensitive hashing. Each of the num_tables hash tables keys
+# the points by bits_per_key randomly chosen cells, so points that
+# differ in only a few cells usually share a bucket in some table.
+# A query only compares itself to the points in its own buckets.
+class LshIndex:
+    def __init__(self, data_points, num_tables, bits_per_key, seed=0):
+        self.data_points = list(data_points)
+
+        # Number of queries that had to fall back to a linear search.
+        self.num_fallbacks = 0
+
+        # Pick the cells that make up each table's key.
+        num_cells = 0
+        if len(self.data_points) > 0:
+            num_cells = len(self.data_points[0].properties)
+        rng = random.Random(seed)
+        self.masks = []
+        for t in range(num_tables):
+            mask = 0
+            for cell in rng.sample(range(num_cells), min(bits_per_key, num_cells)):
+                mask |= 1 << cell
+            self.masks.append(mask)
+
+        # Add each point's index to its bucket in each table.
+        self.tables = [{} for mask in self.masks]
+        for i, dp in enumerate(self.data_points):
+            self.add_to_tables(dp, i)
+
+    # Add a point's index to its bucket in each table.
+    def add_to_tables(self, data_point, i):
+        for table, mask in zip(self.tables, self.masks):
+            key = data_point.bits & mask
+            if key in table:
+                table[key].append(i)
+            else:
+                table[key] = [i]
+
+    # Add a point after the existing ones.
+    def add(self, data_point):
+        self.data_points.append(data_point)
+        self.add_to_tables(data_point, len(self.data_points) - 1)
+
+    # Return (about) the count points closest to data_point, nearest first.
+    def nearest(self, data_point, count):
+        # Gather the points that share a bucket with data_point.
+        candidates = set()
+        for table, mask in zip(self.tables, self.masks):
+            candidates.update(table.get(data_point.bits & mask, ()))
+
+        # If the buckets do not hold enough points, search them all
+        # so knn always gets its votes.
+        if len(candidates) < min(count, len(self.data_points)):
+            self.num_fallbacks += 1
+            candidates = range(len(self.data_points))
+
+        # Rank the candidates. Sorting them first keeps ties in index order.
+        nearest_indices = heapq.nsmallest(count, sorted(candidates),
+            key=lambda i: data_point.hamming_distance(self.data_points[i]))
+        return [self.data_points[i] for i in nearest_indices]
+
+
+# Vectorized KNN for whole batches of patterns.
+# These work on matrices of 0s and 1s (one row per pattern) instead of
+# DataPoint objects, and they do not change any objects.
+
+# Largest number of distances to hold in memory at once.
+BATCH_BLOCK_ELEMENTS = 1 << 22
+
+# Return an array holding the indexes of the count reference rows
+# closest to each query row, nearest first. Rows at the same distance
+# are kept in index order, just like a stable sort.
+# To search the same references many times, pass them as float32 with
+# reference_counts, the sum of each row, so they are not redone each call.
+def nearest_batch(queries, references, count, reference_counts=None):
+    queries = np.asarray(queries)
+    references = np.asarray(references, dtype=np.float32)
+    num_references = len(references)
+    count = min(count, num_references)
+    result = np.empty((len(queries), count), dtype=np.int64)
+    if count == 0: return result
+
+    # For 0s and 1s, |q - r|^2 = q.q + r.r - 2 q.r, and all of
+    # the terms are small whole numbers, so float32 is exact.
+    if reference_counts is None:
+        reference_counts = references.sum(axis=1)
+    indexes = np.arange(num_references, dtype=np.int64)
+    block_size = max(1, BATCH_BLOCK_ELEMENTS // num_references)
+    for start in range(0, len(queries), block_size):
+        block = queries[start:start + block_size].astype(np.float32)
+        distances = block.sum(axis=1)[:, None] + reference_counts[None, :] - 2 * (block @ references.T)
+
+        # Fold the index into the sort key so ties break by index.
+        keys = np.rint(distances).astype(np.int64) * num_references + indexes
+
+        # Select the count smallest keys, then sort only those.
+        if count < num_references:
+            selected = np.argpartition(keys, count - 1, axis=1)[:, :count]
+        else:
+            selected = np.broadcast_to(indexes, keys.shape)
+        order = np.argsort(np.take_along_axis(keys, selected, axis=1), axis=1)
+        result[start:start + len(block)] = np.take_along_axis(selected, order, axis=1)
+    return result
+
+# Each row of neighbor_codes holds the label codes of a query's
+# neighbors, nearest first. Return the winning code for each row.
+# If there is a tie, the code that appears first wins, like vote.
+def vote_batch(neighbor_codes, num_labels):
+    num_queries, k = neighbor_codes.shape
+    rows = np.arange(num_queries)
+    votes = np.zeros((num_queries, num_labels), dtype=np.int64)
+    first_seen = np.full((num_queries, num_labels), k, dtype=np.int64)
+    for j in range(k):
+        votes[rows, neighbor_codes[:, j]] += 1
+    for j in reversed(range(k)):
+        first_seen[rows, neighbor_codes[:, j]] = j
+    return np.argmax(votes * (k + 1) - first_seen, axis=1)
+
+# Use K nearest neighbors to classify each row in queries.
+# references holds the known patterns and labels holds their names.
+# Return an array holding the predicted name for each query.
+def classify_batch(queries, references, labels, k):
+    names, label_codes = np.unique(np.asarray(labels), return_inverse=True)
+    neighbors = nearest_batch(queries, references, k)
+    return names[vote_batch(label_codes[neighbors], len(names))]
+
+
+# Keeps the Hamming distance from a pattern that is being drawn to
+# each reference row. The pattern starts empty. When one of its cells
+# turns on, each distance goes down by 1 if the reference has a 1 in
+# that cell and up by 1 if it has a 0, so nothing is recomputed.
+# cells lists the cells that are on, in the order they turned on.
+class LiveDistances:
+    def __init__(self, references):
+        references = np.asarray(references)
+        self.indexes = np.arange(len(references), dtype=np.int64)
+
+        # The distance from the empty pattern is the number of 1s.
+        self.empty_distances = references.sum(axis=1, dtype=np.int64)
+
+        # deltas[cell] holds the change in each distance when that cell turns on.
+        self.deltas = np.ascontiguousarray(1 - 2 * references.T.astype(np.int64))
+        self.reset()
+
+    # Start again with an empty pattern.
+    def reset(self):
+        self.distances = self.empty_distances.copy()
+        self.cells = []
+
+    # Turn on a cell in the pattern. It must have been off.
+    def turn_on(self, cell):
+        self.distances += self.deltas[cell]
+        self.cells.append(cell)
+
+    # Return the indexes of the count closest reference rows, nearest
+    # first. Like nearest_batch, ties are kept in index order.
+    def nearest_indexes(self, count):
+        count = min(count, len(self.distances))
+        keys = self.distances * len(self.distances) + self.indexes
+        if count < len(keys):
+            selected = np.argpartition(keys, count - 1)[:count]
+        else:
+            selected = self.indexes
+        return selected[np.argsort(keys[selected])]
+
+
+# An inverted file index. A k-means run splits the points into
+# num_cells cells around their centroids, and a query only searches
+# the points in the nprobe cells whose centroids are closest to it.
+# When nprobe is num_cells, every point is searched and the results
+# are exact.
+class IvfIndex:
+    def __init__(self, data_points, num_cells, nprobe, seed=0, max_iterations=100):
+        self.data_points = list(data_points)
+        self.features = np.array([dp.properties for dp in self.data_points], dtype=np.uint8)
+        self.nprobe = nprobe
+
+        # Use k-means to find the centroids. Like k-means_digits, assign
+        # each point to the centroid with the smallest sqrt(L1) distance
+        # (which is the same as the smallest L1 distance).
+        num_cells = max(1, min(num_cells, len(self.data_points)))
+        rng = random.Random(seed)
+        self.centroids = self.features[rng.sample(range(len(self.data_points)), num_cells)].astype(np.float64)
+        assignments = None
+        for iteration in range(max_iterations):
+            new_assignments = self.nearest_cells(self.features, 1)[:, 0]
+            if assignments is not None and np.array_equal(assignments, new_assignments): break
+            assignments = new_assignments
+
+            # Move each centroid to the mean of its points.
+            # A centroid with no points stays where it is.
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, self.features)
+            sizes = np.bincount(assignments, minlength=num_cells)
+            occupied = sizes > 0
+            self.centroids[occupied] = sums[occupied] / sizes[occupied, None]
+
+        # List the points in each cell in index order.
+        self.cells = [np.flatnonzero(assignments == c) for c in range(num_cells)]
+
+    # Return the indexes of the count cells closest to each row in features.
+    def nearest_cells(self, features, count):
+        result = np.empty((len(features), count), dtype=np.int64)
+        block_size = max(1, BATCH_BLOCK_ELEMENTS // (len(self.centroids) * features.shape[1]))
+        for start in range(0, len(features), block_size):
+            block = features[start:start + block_size]
+            distances = np.abs(block[:, None, :] - self.centroids[None, :, :]).sum(axis=2)
+            result[start:start + len(block)] = np.argsort(distances, axis=1, kind='stable')[:, :count]
+        return result
 
-# In[2]:
+    # Return the indexes of the count points closest to a row of
+    # 0s and 1s, nearest first, searching only the nprobe closest cells.
+    def nearest_indexes(self, properties, count):
+        properties = np.asarray(properties, dtype=np.uint8)
+        if self.nprobe >= len(self.cells):
+            candidates = np.arange(len(self.data_points))
+        else:
+            probe = self.nearest_cells(properties[None, :], self.nprobe)[0]
+            candidates = np.sort(np.concatenate([self.cells[c] for c in probe]))
+
+            # If those cells hold too few points, search them all.
+            if len(candidates) < min(count, len(self.data_points)):
+                candidates = np.arange(len(self.data_points))
+
+        # Rank the candidates by distance and then index.
+        distances = np.count_nonzero(self.features[candidates] != properties, axis=1)
+        order = np.lexsort((candidates, distances))[:count]
+        return candidates[order]
+
+    # Return the count points closest to data_point, nearest first.
+    def nearest(self, data_point, count):
+        return [self.data_points[i] for i in self.nearest_indexes(data_point.properties, count)]
+
+
+# Prototype reduction.
+# These pick a small set of prototype rows that classify the
+# rest of the data almost as well as the whole data set does.
+
+# Wilson editing. Remove the rows whose k nearest other rows
+# vote for a different label. This drops noisy points.
+# Return the indexes of the rows to keep.
+def edit_points(features, label_codes, k):
+    neighbors = nearest_batch(features, features, k + 1)
+
+    # Move each row itself to the end of its neighbor list and drop it.
+    is_self = neighbors == np.arange(len(features))[:, None]
+    order = np.argsort(is_self, axis=1, kind='stable')
+    others = np.take_along_axis(neighbors, order, axis=1)[:, :k]
+
+    predictions = vote_batch(label_codes[others], label_codes.max() + 1)
+    return np.flatnonzero(predictions == label_codes)
+
+# Hart's condensed nearest neighbor. Start with one prototype and add
+# every candidate row that its nearest prototype misclassifies, until
+# a whole pass adds nothing. Then every candidate is classified
+# correctly by its nearest prototype.
+# Return the indexes of the prototypes in the order they were added.
+def condense_points(features, label_codes, candidates):
+    if len(candidates) == 0: return np.array([], dtype=np.int64)
+
+    prototypes = [candidates[0]]
+    prototype_features = np.empty((len(candidates), features.shape[1]), dtype=features.dtype)
+    prototype_features[0] = features[candidates[0]]
+    added = True
+    while added:
+        added = False
+        for i in candidates:
+            nearest = nearest_batch(features[i:i + 1], prototype_features[:len(prototypes)], 1)[0, 0]
+            if label_codes[prototypes[nearest]] != label_codes[i]:
+                prototype_features[len(prototypes)] = features[i]
+                prototypes.append(i)
+                added = True
+    return np.array(prototypes, dtype=np.int64)
+
+# Edit (if edit_k > 0) and then condense the rows.
+# Return the indexes of the prototypes.
+def reduce_points(features, label_codes, edit_k=0):
+    candidates = np.arange(len(features))
+    if edit_k > 0:
+        candidates = edit_points(features, label_codes, edit_k)
+    return condense_points(features, label_codes, candidates)
 
 
-import tkinter as tk
+# In[2]:
 
-# The main App class.
+
+import argparse
+import queue
+import threading
+import time
+from digit_loader import add_data_arguments, append_log, data_options, load_dataset, load_model, log_path, \
+    model_key, save_model
+
+# The structure that knn searches.
+#     'list':       Compare the point to each DataPoint in turn.
+#     'bitsliced':  Use a BitSlicedDataset.
+#     'mih':        Use a MultiIndexHash. It is exact but slower than a list
+#                   search on digit data; see knn_digits_benchmark.py.
+#     'unique':     Use a UniquePatternSet.
+#     'ivf':        Use an IvfIndex.
+KNN_INDEX = 'list'
+
+# Approximate KNN settings.
+# If APPROXIMATE_KNN is True, the user's drawings are classified with an
+# LshIndex, and the App reports how well it agrees with the exact search.
+APPROXIMATE_KNN = False
+LSH_NUM_TABLES = 8
+LSH_BITS_PER_KEY = 12
+
+# Inverted file index settings.
+# If COMPARE_IVF is True, the App compares the IvfIndex's
+# accuracy and speed to a brute force search for each K.
+COMPARE_IVF = False
+IVF_NUM_CELLS = 16
+IVF_NPROBE = 4
+
+# If LIVE_PREDICTION is True, the App shows the predicted digit while
+# the user is still drawing. It is updated each time the stroke enters
+# a new cell, using a LiveDistances for the whole data set and the best K
+# so far. The final prediction when the mouse is released uses the
+# settings above as usual.
+LIVE_PREDICTION = True
+
+# Prototype settings.
+# If USE_PROTOTYPES is True, the user's drawings are classified against
+# the prototypes found by reduce_points using PROTOTYPE_K neighbors.
+# The prototypes are saved in PROTOTYPE_DIRECTORY and are rebuilt
+# when the data (including added drawings), grid, or EDIT_K change.
+# EDIT_K is the K used to edit out noisy points first (0 for no editing).
+USE_PROTOTYPES = False
+PROTOTYPE_DIRECTORY = 'knn_digits.prototypes'
+PROTOTYPE_K = 1
+EDIT_K = 3
+
+# The best K is saved here after training. Later runs on the same data
+# with the same K range load it instead of testing every K again.
+MODEL_DIRECTORY = 'knn_digits.model'
+
+# How often, in milliseconds, the App checks for progress
+# messages from the training thread.
+TRAINING_POLL_MS = 100
 
 # Geometry constants.
 NUM_ROWS = 8
@@ -66,46 +672,495 @@ NUM_COLS = 6
 CELL_WID = 20
 CELL_HGT = CELL_WID
 MARGIN = 5
-WINDOW_WID = NUM_COLS * CELL_WID + 100
-WINDOW_HGT = NUM_ROWS * CELL_HGT + 40
 
-class App:
-    # Create and manage the tkinter interface.
-    def __init__(self):
+# Stroke drawing settings. Mouse motion is drawn at most once every
+# FRAME_MS milliseconds, and a point is only added to the drawn line
+# if it is at least MIN_DRAW_DISTANCE pixels from the last point drawn
+# (use 0 to draw every point). Every point is still used to find the
+# touched cells.
+FRAME_MS = 16
+MIN_DRAW_DISTANCE = 2
+
+# The data to load. If IDX_IMAGES_FILE and IDX_LABELS_FILE are set,
+# load those IDX (MNIST format) files and shrink the images to a
+# NUM_ROWS x NUM_COLS grid. Otherwise load DATA_FILE.
+DATA_FILE = 'digit_data.txt'
+IDX_IMAGES_FILE = None
+IDX_LABELS_FILE = None
+
+# The part of the app that does not need a display. It loads the
+# data, finds the best K, and classifies patterns.
+class KnnDigits:
+    def __init__(self, data_file=DATA_FILE, idx_images_file=IDX_IMAGES_FILE,
+        idx_labels_file=IDX_LABELS_FILE, num_rows=NUM_ROWS, num_cols=NUM_COLS):
         self.network = None
         self.k = 0
         self.best_rate = 0
+        # Success rates found by test_ks, indexed by K.
+        self.k_rates = {}
+        self.prototype_index = None
+
+        # Training may run in another thread, so make sure
+        # only one thread builds the knn index.
+        self.index_lock = threading.Lock()
+
+        # The data to load.
+        self.data_file = data_file
+        self.idx_images_file = idx_images_file
+        self.idx_labels_file = idx_labels_file
+        self.requested_rows = num_rows
+        self.requested_cols = num_cols
+
+    # Display a status message. The App shows it in its window.
+    def show_status(self, text):
+        pass
+
+    # Find the best K between min_k and max_k and report the results.
+    # Use the saved model if there is one for this data and K range,
+    # unless retrain is True.
+    def train(self, min_k=3, max_k=20, retrain=False):
+        params = {'min_k': min_k, 'max_k': max_k}
+        if not retrain and self.load_trained_model(params):
+            print(f'Using the model saved in {MODEL_DIRECTORY}')
+        else:
+            # Test K values between min_k and max_k.
+            self.test_ks(min_k, max_k)
+            self.save_trained_model(params)
+
+        # Test one more time with the best K to display the result.
+        self.test_data(self.k)
+        print(f'Final K: {self.k} Rate {self.best_rate}\n')
+
+        # Compare the approximate search to the exact one.
+        if APPROXIMATE_KNN:
+            self.test_data(self.k, approximate=True)
+
+        # Compare the inverted file index to a brute force search.
+        if COMPARE_IVF:
+            self.compare_ivf(min_k, max_k, IVF_NPROBE)
+
+        # Load or build the prototypes and see how well they do.
+        if USE_PROTOTYPES:
+            self.load_prototypes()
+            self.test_prototypes()
+
+    # Load the data points.
+    def load_data(self):
+        # Load the digits into arrays. The DataPoints are
+        # only made when something needs them.
+        self.dataset = load_dataset(self.data_file, self.idx_images_file,
+            self.idx_labels_file, self.requested_rows, self.requested_cols)
+        self.num_rows = self.dataset.num_rows
+        self.num_cols = self.dataset.num_cols
+        self.data_points = self.dataset.data_points(DataPoint)
+        self.summarize_data()
+
+        # The structures that knn searches are built when they are first needed.
+        self.knn_index = None
+        self.lsh_index = None
+        self.live_distances = None
+
+    # Make the arrays that the tests and batch searches use.
+    def summarize_data(self):
+        self.features = self.dataset.features
+        self.names, self.label_codes = np.unique(self.dataset.labels, return_inverse=True)
+
+        # Collapse duplicate patterns. Points with the same pattern
+        # always get the same prediction, so the tests only need to
+        # classify each unique pattern once. The unique patterns get
+        # a matrix of their own plus the number of points with each name.
+        self.unique_points = UniquePatternSet(self.data_points, self.features)
+        self.unique_features = self.features[self.unique_points.indexes]
+        self.unique_name_counts = np.bincount(
+            self.unique_points.pattern_numbers * len(self.names) + self.label_codes,
+            minlength=len(self.unique_features) * len(self.names)).reshape(-1, len(self.names))
+
+    # Add a point that was just appended to the dataset to the
+    # arrays made by summarize_data without rebuilding them.
+    def add_to_summary(self, data_point):
+        self.features = self.dataset.features
+
+        # A new name changes every label code, so start over.
+        code = np.searchsorted(self.names, data_point.name)
+        if code == len(self.names) or self.names[code] != data_point.name:
+            self.summarize_data()
+            return
+        self.label_codes = np.append(self.label_codes, code)
+
+        number = self.unique_points.add(data_point, data_point.properties)
+        if number == len(self.unique_features):
+            self.unique_features = np.concatenate((self.unique_features, self.features[-1:]))
+            self.unique_name_counts = np.concatenate((self.unique_name_counts,
+                np.zeros((1, len(self.names)), dtype=self.unique_name_counts.dtype)))
+        self.unique_name_counts[number, code] += 1
+
+    # Add a labelled drawing to the reference points and save it in the
+    # data file's log so it is loaded next time. The indexes that can
+    # insert a point do so, and the others are rebuilt when next needed.
+    # The live distances are rebuilt now, since a stroke may be in progress.
+    # K is not tested again, but the success rates found for
+    # each K are forgotten because they are for the old data.
+    def add_sample(self, zeros_and_ones, name):
+        data_point = DataPoint(f'{name}: {zeros_and_ones}')
+        append_log(log_path(self.idx_images_file or self.data_file), name,
+            data_point.properties, self.num_rows, self.num_cols)
+
+        with self.index_lock:
+            self.dataset.append(data_point.properties, name)
+            self.data_points.append(data_point)
+            self.add_to_summary(data_point)
+            self.k_rates = {}
+
+            if self.knn_index is not self.data_points:
+                if hasattr(self.knn_index, 'add'):
+                    self.knn_index.add(data_point)
+                else:
+                    self.knn_index = None
+            if self.lsh_index is not None:
+                self.lsh_index.add(data_point)
+
+            # Turn on the cells of the pattern being drawn again.
+            if self.live_distances is not None:
+                cells = self.live_distances.cells
+                self.live_distances = LiveDistances(self.features)
+                for cell in cells:
+                    self.live_distances.turn_on(cell)
+
+    # Build the structure that knn searches.
+    def build_knn_index(self):
+        if KNN_INDEX == 'unique':
+            self.knn_index = self.unique_points
+        elif KNN_INDEX == 'bitsliced':
+            self.knn_index = BitSlicedDataset(self.data_points)
+        elif KNN_INDEX == 'mih':
+            self.knn_index = MultiIndexHash(self.data_points)
+        elif KNN_INDEX == 'ivf':
+            self.knn_index = IvfIndex(self.data_points, IVF_NUM_CELLS, IVF_NPROBE)
+        else:
+            self.knn_index = self.data_points
+
+        # Build the approximate index too if we will use it.
+        if APPROXIMATE_KNN and self.lsh_index is None:
+            self.lsh_index = LshIndex(self.data_points, LSH_NUM_TABLES, LSH_BITS_PER_KEY)
+
+    # Test each of the data points with this value for K.
+    # Return the success rate. A point is a success when its
+    # neighbors vote for its known name; the rate can change with K.
+    # If approximate is True, use the LshIndex instead and also report
+    # its recall against the exact search, how often the two searches
+    # predict the same name, and the mean time per query.
+    def test_data(self, k, approximate=False):
+        if approximate:
+            return self.test_approximate_data(k)
+
+        # If test_ks already swept this K, just look up the result.
+        if k in self.k_rates:
+            success_rate = self.k_rates[k]
+            self.show_status(f'K = {k}, success rate: {success_rate}%')
+            print(f'K = {k}, Success Rate = {success_rate}%')
+            return success_rate
+
+        # Classify each unique pattern once and count a success
+        # for every point with that pattern and the predicted name.
+        neighbors = nearest_batch(self.unique_features, self.features, k)
+        predictions = vote_batch(self.label_codes[neighbors], len(self.names))
+        num_successes = int(self.unique_name_counts[np.arange(len(predictions)), predictions].sum())
+
+        success_rate = round(100 * num_successes / len(self.data_points), 1)
+        self.show_status(f'K = {k}, success rate: {success_rate}%')
+        print(f'K = {k}, Success Rate = {success_rate}%')
+        return success_rate
+
+    # Test each of the data points with this value for K using the
+    # LshIndex, comparing each result to the exact search.
+    # Return the approximate success rate.
+    def test_approximate_data(self, k):
+        with self.index_lock:
+            if self.knn_index is None:
+                self.build_knn_index()
+            if self.lsh_index is None:
+                self.lsh_index = LshIndex(self.data_points, LSH_NUM_TABLES, LSH_BITS_PER_KEY)
+
+        num_successes = 0
+        num_agreements = 0
+        num_found = 0
+        exact_time = 0
+        approximate_time = 0
+        for dp in self.data_points:
+            start_time = time.perf_counter()
+            exact_neighbors = dp.nearest(self.knn_index, k)
+            exact_time += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            approximate_neighbors = dp.nearest(self.lsh_index, k)
+            approximate_time += time.perf_counter() - start_time
+
+            # Count the true neighbors that the approximate search found.
+            exact_ids = set(id(point) for point in exact_neighbors)
+            num_found += sum(1 for point in approximate_neighbors if id(point) in exact_ids)
+
+            name = vote(approximate_neighbors)
+            if name == dp.name:
+                num_successes += 1
+            if name == vote(exact_neighbors):
+                num_agreements += 1
+
+        num_points = len(self.data_points)
+        success_rate = round(100 * num_successes / num_points, 1)
+        recall = round(100 * num_found / (num_points * min(k, num_points)), 1)
+        agreement = round(100 * num_agreements / num_points, 1)
+        self.show_status(f'K = {k}, LSH success rate: {success_rate}%')
+        print(f'K = {k}, LSH Success Rate = {success_rate}%, Recall = {recall}%, '
+            f'Label Agreement = {agreement}%')
+        print(f'    Mean query time: LSH {1000 * approximate_time / num_points:.3f} ms, '
+            f'exact {1000 * exact_time / num_points:.3f} ms, '
+            f'{self.lsh_index.num_fallbacks} linear fallbacks')
+        return success_rate
+
+    # Repeat the test_ks sweep with an IvfIndex that probes nprobe cells.
+    # Print the success rate for each K next to the brute force rate,
+    # plus the mean query time for each search.
+    def compare_ivf(self, min_k, max_k, nprobe):
+        ivf_index = IvfIndex(self.data_points, IVF_NUM_CELLS, nprobe)
+        brute_force_rates = self.sweep_ks(min_k, max_k)
+
+        # Find each unique pattern's neighbors both ways. Prepare the
+        # brute force references once, as the IvfIndex prepares its own.
+        references = self.features.astype(np.float32)
+        reference_counts = references.sum(axis=1)
+        num_queries = len(self.unique_features)
+        ivf_neighbors = np.empty((num_queries, min(max_k, len(self.features))), dtype=np.int64)
+        brute_force_time = 0
+        ivf_time = 0
+        for u in range(num_queries):
+            start_time = time.perf_counter()
+            nearest_batch(self.unique_features[u:u + 1], references, max_k, reference_counts)
+            brute_force_time += time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            ivf_neighbors[u] = ivf_index.nearest_indexes(self.unique_features[u], max_k)
+            ivf_time += time.perf_counter() - start_time
+
+        print(f'IVF: {len(ivf_index.cells)} cells, nprobe = {nprobe}')
+        rows = np.arange(num_queries)
+        for k in range(min_k, max_k + 1):
+            predictions = vote_batch(self.label_codes[ivf_neighbors[:, :k]], len(self.names))
+            num_successes = int(self.unique_name_counts[rows, predictions].sum())
+            success_rate = round(100 * num_successes / len(self.data_points), 1)
+            print(f'    K = {k}, Success Rate = {success_rate}% (brute force {brute_force_rates[k]}%)')
+        print(f'    Mean query time: IVF {1000 * ivf_time / num_queries:.3f} ms, '
+            f'brute force {1000 * brute_force_time / num_queries:.3f} ms')
+
+    # Load the prototypes saved in PROTOTYPE_DIRECTORY for this data
+    # and EDIT_K. If there are none, build the prototypes and save them.
+    def load_prototypes(self):
+        key = model_key(self.dataset, {'edit_k': EDIT_K})
+        model = load_model(PROTOTYPE_DIRECTORY, key)
+        if model is not None:
+            indexes = model['indexes'].tolist()
+        else:
+            indexes = reduce_points(self.features, self.label_codes, EDIT_K)
+            try:
+                save_model(PROTOTYPE_DIRECTORY, key, {'indexes': indexes}, {})
+            except OSError:
+                # We can still use the prototypes if they cannot be saved.
+                pass
+
+        self.prototypes = [self.data_points[i] for i in indexes]
+        self.prototype_index = MultiIndexHash(self.prototypes)
+
+    # Classify every data point against the prototypes and
+    # compare the success rate to the one for the full data set.
+    # Return the prototypes' success rate.
+    def test_prototypes(self):
+        names = classify_batch(self.features,
+            [dp.properties for dp in self.prototypes],
+            [dp.name for dp in self.prototypes], PROTOTYPE_K)
+        num_successes = int(np.sum(names == self.names[self.label_codes]))
+        success_rate = round(100 * num_successes / len(self.data_points), 1)
+
+        print(f'Prototypes: {len(self.prototypes)} of {len(self.data_points)} points, '
+            f'K = {PROTOTYPE_K}, Success Rate = {success_rate}% '
+            f'(full set: K = {self.k}, Success Rate = {self.best_rate}%)')
+        self.show_status(f'{len(self.prototypes)} prototypes, success rate: {success_rate}%')
+        return success_rate
+
+    # Test every K between min_k and max_k in a single pass.
+    # Each point's neighbors are ranked once, and the votes are
+    # counted for every K while walking down that ranking.
+    # Return a dictionary holding the success rate for each K.
+    def sweep_ks(self, min_k, max_k):
+        num_successes = {}
+
+        # Rank the neighbors of each unique pattern once.
+        neighbors = nearest_batch(self.unique_features, self.features, max_k)
+        neighbor_codes = self.label_codes[neighbors]
+
+        # Vote with the first k neighbors for each K. When there are
+        # fewer than k points, the slice holds all of them.
+        rows = np.arange(len(neighbors))
+        for k in range(min_k, max_k + 1):
+            predictions = vote_batch(neighbor_codes[:, :k], len(self.names))
+            num_successes[k] = int(self.unique_name_counts[rows, predictions].sum())
+
+        return {k: round(100 * num_successes[k] / len(self.data_points), 1)
+            for k in num_successes}
+
+    # Test different values for K.
+    # self.k always holds the best K found so far, so
+    # classify_data_point can use it while training continues.
+    def test_ks(self, min_k, max_k):
+        # Find all of the success rates at once so
+        # test_data only needs to look them up.
+        self.k_rates.update(self.sweep_ks(min_k, max_k))
+
+        for k in range(min_k, max_k + 1):
+            success_rate = self.test_data(k)
+            if k == min_k or success_rate > self.best_rate:
+                self.best_rate = success_rate
+                self.k = k
+
+    # Load the best K and the success rates saved by save_trained_model.
+    # Return False if there is no saved model for this data and params.
+    def load_trained_model(self, params):
+        model = load_model(MODEL_DIRECTORY, model_key(self.dataset, params))
+        if model is None:
+            return False
+        self.k_rates.update((k, rate) for k, rate in model['k_rates'])
+        self.best_rate = model['best_rate']
+        self.k = model['k']
+        return True
+
+    # Save the best K and the success rates for each K.
+    def save_trained_model(self, params):
+        try:
+            save_model(MODEL_DIRECTORY, model_key(self.dataset, params), {}, {
+                'k': self.k,
+                'best_rate': self.best_rate,
+                'k_rates': sorted(self.k_rates.items()),
+            })
+        except OSError:
+            # We can still use the model if it cannot be saved.
+            pass
+
+    # Return True if there is a model to classify with. During
+    # training this may be a provisional one that uses the best K so far.
+    def has_model(self):
+        if USE_PROTOTYPES:
+            return self.prototype_index is not None
+        return self.k > 0
+
+    # Use KNN to give a DataPoint a new name.
+    def classify_data_point(self, data_point):
+        with self.index_lock:
+            if self.knn_index is None:
+                self.build_knn_index()
+        if USE_PROTOTYPES:
+            data_point.knn(self.prototype_index, PROTOTYPE_K)
+        elif APPROXIMATE_KNN:
+            data_point.knn(self.lsh_index, self.k)
+        else:
+            data_point.knn(self.knn_index, self.k)
+        return data_point.name
+
+    # Start predicting a new pattern, which begins with no cells on.
+    def start_live_prediction(self):
+        if self.live_distances is None:
+            self.live_distances = LiveDistances(self.features)
+        self.live_distances.reset()
+
+    # Turn on a cell in the pattern being predicted. Return the name
+    # KNN gives the pattern now, or None if there is no K yet. Every
+    # touched cell must be turned on, even before training finds a K,
+    # so the distances always match the pattern that has been drawn.
+    def update_live_prediction(self, cell):
+        self.live_distances.turn_on(cell)
+        if not self.has_model():
+            return None
+        neighbors = self.live_distances.nearest_indexes(self.k)
+        return self.names[vote_batch(self.label_codes[neighbors][None, :], len(self.names))[0]]
+
+    # Return the name KNN gives a string of 0s and 1s.
+    def classify_pattern(self, zeros_and_ones):
+        return self.classify_data_point(DataPoint(f'?: {zeros_and_ones}'))
+
+    # Return an array holding the names KNN gives to each row of 0s and 1s.
+    def classify_patterns(self, features):
+        return classify_batch(features, self.features, self.dataset.labels, self.k)
+
+
+# In[3]:
+
+
+# The main App class.
+class App(KnnDigits):
+    # Create and manage the tkinter interface.
+    def __init__(self, min_k=3, max_k=20, retrain=False, **data_options):
+        KnnDigits.__init__(self, **data_options)
+
+        # Import tkinter here so the rest of the module works without a display.
+        global tk
+        import tkinter as tk
 
         # Make the main interface.
         self.window = tk.Tk()
         self.window.title('knn_digits')
         self.window.protocol('WM_DELETE_WINDOW', self.kill_callback)
-        self.window.geometry(f'{WINDOW_WID}x{WINDOW_HGT}')
 
-        # Build the rest of the UI.
-        self.build_ui()
+        # Typing a digit adds the last drawing to the data with that name.
+        self.window.bind('<Key>', self.label_drawing)
 
-        # Load the data.
+        # Load the data. This tells us the size of the grid.
         self.load_data()
-        # Test K values between 3 and 20.
-        self.test_ks(3, 20)
-        # Test one more time with the best K to display the result.
-        self.test_data(self.k)
-        print(f'Final K: {self.k} Rate {self.best_rate}\n')
+        self.window.geometry(f'{self.num_cols * CELL_WID + 100}x{self.num_rows * CELL_HGT + 40}')
+
+        # Build the rest of the UI.
+        self.build_ui()
 
         # Initially we have nothing to draw.
         self.polyline = None
         self.points = []
+        self.drawn_points = []
+        self.redraw_pending = None
+        self.last_pattern = None
+
+        # Find the best K in the background so the window stays responsive.
+        self.start_training(min_k, max_k, retrain)
 
         # Display the window.
         self.window.focus_force()
         self.window.mainloop()
 
+    # Start training in a worker thread. Its status messages are
+    # passed to the window by poll_training.
+    def start_training(self, min_k, max_k, retrain):
+        self.status_queue = queue.Queue()
+        self.training_thread = threading.Thread(
+            target=self.train, args=(min_k, max_k, retrain), daemon=True)
+        self.training_thread.start()
+        self.window.after(TRAINING_POLL_MS, self.poll_training)
+
+    # Display any status messages from the training thread.
+    # Keep checking until the thread finishes.
+    def poll_training(self):
+        # See if training is running before taking the messages
+        # so we don't miss any that it sends just before it stops.
+        still_training = self.training_thread.is_alive()
+        while not self.status_queue.empty():
+            self.success_rate_value.set(self.status_queue.get())
+        if still_training:
+            self.window.after(TRAINING_POLL_MS, self.poll_training)
+
+    # Display a status message below the drawing. This may be called by
+    # the training thread, which must not touch tkinter, so just queue it.
+    def show_status(self, text):
+        self.status_queue.put(text)
+
     # Build the tkinter user interface.
     def build_ui(self):
         # Make the drawing canvas.
-        canvas_wid = NUM_COLS * CELL_WID + 1
-        canvas_hgt = NUM_ROWS * CELL_HGT + 1
+        canvas_wid = self.num_cols * CELL_WID + 1
+        canvas_hgt = self.num_rows * CELL_HGT + 1
         self.canvas = tk.Canvas(self.window, bg='white',
             borderwidth=0, highlightthickness=0, relief=tk.SUNKEN, width=canvas_wid, height=canvas_hgt)
         self.canvas.place(x=MARGIN, y=MARGIN)
@@ -113,9 +1168,9 @@ class App:
         self.canvas.bind('<ButtonRelease-1>', self.end_draw)
 
         # Make grid lines.
-        for r in range(NUM_ROWS + 1):
+        for r in range(self.num_rows + 1):
             self.canvas.create_line(0, r * CELL_HGT, canvas_wid, r * CELL_HGT, fill='lime')
-        for c in range(NUM_COLS + 1):
+        for c in range(self.num_cols + 1):
             self.canvas.create_line(c * CELL_WID, 0, c * CELL_WID, canvas_hgt, fill='lime')
 
         # Make a label to display success percentage.
@@ -128,77 +1183,51 @@ class App:
         self.user_result_label = tk.Label(self.window, font=('Calibri 100 normal'), textvariable=self.user_result_value)
         self.user_result_label.place(x=canvas_wid + 2 * MARGIN, y=MARGIN)
 
-    # Load the data points.
-    def load_data(self):
-        with open('digit_data.txt', 'r') as f:
-            lines = f.readlines()
-            self.data_points = []
-            for line in lines:
-                self.data_points.append(DataPoint(line))
-
-    # Test each of the data points with this value for K.
-    # Return the success rate.
-
-    # We iterate over self.data_points. foreach data_points as dp
-    # we call dp.knn(data_points, k) - that sets dp.name
-    # Then we compare the dp.name with the name that we know 
-    # class DataPoint:
-    # The data_string parameter is a string holding the digit, 0s, and 1s
-    # in the format '6: 011110110000100000111111110001110001010001001111'
-    # The name that is 'name:'
-    # If dp.name == known_name - that's a success. The idea is that 
-    # Depending on different k, success rate might fluctuate (!)
-
-    def test_data(self, k):
-        num_successes = 0
-
-        for dp in self.data_points:
-            known_name = dp.name
-            dp.knn(self.data_points, k)  # This should set dp.name to the predicted name
-
-            if dp.name == known_name:
-                num_successes += 1
-            else:
-                dp.name = known_name  # Reset dp.name to the known name after testing
-
-        success_rate = round(100 * num_successes / len(self.data_points), 1)
-        self.success_rate_value.set(f'K = {k}, success rate: {success_rate}%')
-        print(f'K = {k}, Success Rate = {success_rate}%')
-        return success_rate
-
-
-    # Test different values for K.
-    def test_ks(self, min_k, max_k):
-        best_k = min_k
-        best_success_rate = 0
-
-        for k in range(min_k, max_k + 1):
-            success_rate = self.test_data(k)
-            if success_rate > best_success_rate:
-                best_success_rate = success_rate
-                best_k = k
-
-        self.k = best_k
-        self.best_rate = best_success_rate
-
-    # The user has moved the mouse while drawing.
-    # Remove the existing polyline and draw a new one.
-
+    # Draw the stroke's points. The polyline is made once per stroke,
+    # and after that its coordinates are updated in place.
     def redraw(self):
-        # Remove old polyline.
-        self.canvas.delete(self.polyline)
-        self.polyline = None
-
-        # Draw current points.
-        if len(self.points) > 1:
-            self.polyline = self.canvas.create_line(self.points, fill='black')
+        self.redraw_pending = None
+        if len(self.drawn_points) < 2:
+            return
+        if self.polyline is None:
+            self.polyline = self.canvas.create_line(self.drawn_points, fill='black')
+        else:
+            self.canvas.coords(self.polyline, self.drawn_points)
+
+    # Redraw at the next frame. Motion events that
+    # arrive before then are all drawn at once.
+    def schedule_redraw(self):
+        if self.redraw_pending is None:
+            self.redraw_pending = self.window.after(FRAME_MS, self.redraw)
+
+    # Draw any points that are waiting for the next frame now.
+    def flush_redraw(self):
+        if self.redraw_pending is not None:
+            self.window.after_cancel(self.redraw_pending)
+            self.redraw()
+
+    # Remove the stroke and forget its points.
+    def clear_drawing(self):
+        if self.redraw_pending is not None:
+            self.window.after_cancel(self.redraw_pending)
+            self.redraw_pending = None
+        if self.polyline is not None:
+            self.canvas.delete(self.polyline)
+            self.polyline = None
+        self.points = []
+        self.drawn_points = []
 
     # The user has pressed the mouse down over the canvas.
     # Start drawing.
     def start_draw(self, event):
         # Remove any previous drawing.
-        self.points = []
-        self.redraw()
+        self.clear_drawing()
+
+        # Start with no touched cells.
+        self.touched = [[0 for c in range(self.num_cols)] for r in range(self.num_rows)]
+        if LIVE_PREDICTION:
+            self.user_result_value.set('')
+            self.start_live_prediction()
 
         self.canvas.bind('<B1-Motion>', self.save_point)
 
@@ -206,23 +1235,43 @@ class App:
     # Finsish drawing.
     def end_draw(self, event):
         self.canvas.unbind('<B1-Motion>')
+        self.flush_redraw()
 
         # Evaluate the polyline.
         self.evaluate_polyline()
 
     # The user has moved the mouse while drawing.
     # Save the current mouse position and redraw the polyline.
+    # If the point is in a new cell, update the live prediction.
     def save_point(self, event):
         self.points.append((event.x, event.y))
-        self.redraw()
+
+        # Draw the point if it is far enough from the last one drawn.
+        if len(self.drawn_points) == 0 or \
+            (event.x - self.drawn_points[-1][0]) ** 2 + \
+            (event.y - self.drawn_points[-1][1]) ** 2 >= MIN_DRAW_DISTANCE ** 2:
+            self.drawn_points.append((event.x, event.y))
+            self.schedule_redraw()
+
+        cell = self.touch_point(event.x, event.y)
+        if cell is not None and LIVE_PREDICTION:
+            name = self.update_live_prediction(cell)
+            if name is not None:
+                self.user_result_value.set(name)
 
     # Use KNN to see which digit this may be.
     def evaluate_polyline(self):
+        # Wait until training has found at least one K.
+        if not self.has_model():
+            self.user_result_value.set('?')
+            print('Digit: ? (still training)')
+            return
+
         # Convert the polyline into a DataPoint.
         data_point = self.polyline_to_data_point()
 
-        # Use KNN to give it a new name.
-        data_point.knn(self.data_points, self.k)
+        # Use KNN to give it a new name. This uses the best K found so far.
+        self.classify_data_point(data_point)
 
         # Display the result.
         self.user_result_value.set(data_point.name)
@@ -230,11 +1279,11 @@ class App:
 
     # Convert the polyline into a DataPoint.
     def polyline_to_data_point(self):
-        # Convert the points into the cells that were touched.
-        touched = self.get_touched()
-
         # Convert the touched cells to a string.
-        touched_string = self.touched_to_string(touched)
+        touched_string = self.touched_to_string(self.touched)
+
+        # Remember the pattern so the user can label it.
+        self.last_pattern = touched_string
 
         # Compose the DataPoint data string.
         data_string = f'?: {touched_string}'
@@ -242,32 +1291,39 @@ class App:
         # Create the DataPoint.
         return DataPoint(data_string)
 
-    # Convert the points in the polyline into the cells that were touched.
-    def get_touched(self):
-        # Make a touched array holding 0s.
-        touched = []
-        for r in range(NUM_ROWS):
-            touched.append([0 for i in range(NUM_COLS)])
-
-        # Mark the touched cells.
-        for point in self.points:
-            r = int(point[1] / CELL_HGT)
-            c = int(point[0] / CELL_WID)
-            if r >= 0 and r < NUM_ROWS and c >= 0 and c < NUM_COLS:
-                touched[r][c] = 1
-
-        # Return the touched list.
-        return touched
+    # Mark the cell under a point in the polyline as touched.
+    # Return the cell's number if it was not already touched, otherwise None.
+    def touch_point(self, x, y):
+        r = int(y / CELL_HGT)
+        c = int(x / CELL_WID)
+        if r >= 0 and r < self.num_rows and c >= 0 and c < self.num_cols and not self.touched[r][c]:
+            self.touched[r][c] = 1
+            return r * self.num_cols + c
+        return None
 
     # Return a string holding the touch values so
     # we can use it to initialize a DataPoint object.
     def touched_to_string(self, touched):
         result = ''
-        for r in range(NUM_ROWS):
-            for c in range(NUM_COLS):
+        for r in range(self.num_rows):
+            for c in range(self.num_cols):
                 result += str(touched[r][c])
         return result
 
+    # The user has typed a key. If it is a digit, add the
+    # last drawing to the data with that digit as its name.
+    def label_drawing(self, event):
+        if len(event.char) != 1 or event.char not in '0123456789' or self.last_pattern is None:
+            return
+        if self.training_thread.is_alive():
+            self.success_rate_value.set('Training, try again soon')
+            return
+
+        self.add_sample(self.last_pattern, event.char)
+        self.last_pattern = None
+        self.success_rate_value.set(f'Added a {event.char}, {len(self.data_points)} digits')
+        print(f'Added: {event.char}')
+
     def kill_callback(self):
         self.window.destroy()
 
@@ -275,7 +1331,48 @@ class App:
 # In[10]:
 
 
-App()
+# Run the App, or with --headless, just train and print the results.
+def main():
+    parser = argparse.ArgumentParser(description='Use K nearest neighbors to classify drawn digits.')
+    add_data_arguments(parser, DATA_FILE, NUM_ROWS, NUM_COLS)
+    parser.add_argument('--headless', action='store_true',
+        help='train and print the results without opening a window')
+    parser.add_argument('--min-k', type=int, default=3, help='smallest K to test')
+    parser.add_argument('--max-k', type=int, default=20, help='largest K to test')
+    parser.add_argument('--retrain', action='store_true',
+        help=f'train even if {MODEL_DIRECTORY} holds a model for this data')
+    parser.add_argument('--classify', nargs='+', default=[], metavar='PATTERN',
+        help='strings of 0s and 1s to classify after training (with --headless)')
+    parser.add_argument('--add', nargs='+', default=[], metavar='DIGIT:PATTERN',
+        help='labelled drawings to add to the data before classifying (with --headless)')
+    args = parser.parse_args()
+
+    if not args.headless:
+        App(args.min_k, args.max_k, args.retrain, **data_options(args))
+        return
+
+    knn_digits = KnnDigits(**data_options(args))
+    start_time = time.perf_counter()
+    knn_digits.load_data()
+    print(f'Loaded {len(knn_digits.data_points)} digits in {time.perf_counter() - start_time:.3f} seconds')
+
+    start_time = time.perf_counter()
+    knn_digits.train(args.min_k, args.max_k, args.retrain)
+    print(f'Trained in {time.perf_counter() - start_time:.3f} seconds')
+
+    for sample in args.add:
+        name, pattern = sample.split(':')
+        knn_digits.add_sample(pattern, name)
+        print(f'Added {name}: {pattern}')
+
+    for pattern in args.classify:
+        start_time = time.perf_counter()
+        name = knn_digits.classify_pattern(pattern)
+        print(f'{pattern}: {name} ({1000 * (time.perf_counter() - start_time):.3f} ms)')
+
+
+if __name__ == '__main__':
+    main()
 
 
 # In[ ]:
@@ -64,6 +64,10 @@ class DataPoint:
 # Naive Bayes functions.
 import math
 
+# Standard deviations smaller than this are raised to this value
+# so a property that never varies can't make a probability zero.
+MIN_STD_DEV = 0.1
+
 # Separate points into clusters.
 # Return a cluster dictionary where dictionary[cluster_name]
 # is a list of points assigned to this cluster.
@@ -84,8 +88,6 @@ def make_cluster_dictionary(data_points):
 #    std devs
 # The means and std_devs lists contain lists of values for each cluster.
 def summarize_points(num_points, cluster_dictionary):
-    MIN_STD_DEV = 0.1
-
     cluster_names = []  # One name per cluster
     fractions = []      # Fraction of objects in each cluster
     means = []          # For each cluster, a list of means for each property
@@ -126,8 +128,11 @@ def calculate_probability(x, mean, stdev):
 # In[58]:
 
 
-import tkinter as tk
+import argparse
 import random
+import time
+from digit_loader import add_data_arguments, append_log, data_options, load_dataset, load_model, log_path, \
+    model_key, save_model
 
 # Geometry constants.
 NUM_ROWS = 8
@@ -135,66 +140,289 @@ NUM_COLS = 6
 CELL_WID = 20
 CELL_HGT = CELL_WID
 MARGIN = 5
-WINDOW_WID = NUM_COLS * CELL_WID + 100
-WINDOW_HGT = NUM_ROWS * CELL_HGT + 40
 
-class App:
+# Stroke drawing settings. Mouse motion is drawn at most once every
+# FRAME_MS milliseconds, and a point is only added to the drawn line
+# if it is at least MIN_DRAW_DISTANCE pixels from the last point drawn
+# (use 0 to draw every point). Every point is still used to find the
+# touched cells.
+FRAME_MS = 16
+MIN_DRAW_DISTANCE = 2
+
+# The data to load. If IDX_IMAGES_FILE and IDX_LABELS_FILE are set,
+# load those IDX (MNIST format) files and shrink the images to a
+# NUM_ROWS x NUM_COLS grid. Otherwise load DATA_FILE.
+DATA_FILE = 'digit_data.txt'
+IDX_IMAGES_FILE = None
+IDX_LABELS_FILE = None
+
+# The trained model is saved here. Later runs on the same
+# data load it instead of training again.
+MODEL_DIRECTORY = 'naive_bayes_digits.model'
+
+# The part of the app that does not need a display. It loads
+# the data, trains the naive Bayes model, and classifies patterns.
+class NaiveBayesDigits:
+    def __init__(self, data_file=DATA_FILE, idx_images_file=IDX_IMAGES_FILE,
+        idx_labels_file=IDX_LABELS_FILE, num_rows=NUM_ROWS, num_cols=NUM_COLS):
+        # The data to load.
+        self.data_file = data_file
+        self.idx_images_file = idx_images_file
+        self.idx_labels_file = idx_labels_file
+        self.requested_rows = num_rows
+        self.requested_cols = num_cols
+
+    # Display a status message. The App shows it in its window.
+    def show_status(self, text):
+        pass
+
+    # Train the model and report its success rate. Use the saved
+    # model if there is one for this data, unless retrain is True.
+    def train(self, retrain=False):
+        params = {'min_std_dev': MIN_STD_DEV}
+        if not retrain and self.load_trained_model(params):
+            print(f'Using the model saved in {MODEL_DIRECTORY}')
+        else:
+            # Train for naive Bayes classification.
+            self.classify()
+
+            # Calculate the success rate.
+            self.calculate_success_rate(self.data_points)
+            self.save_trained_model(params)
+
+        # The running counts that add_sample uses are made when first needed.
+        self.cluster_counts = None
+
+        # Display the final results.
+        self.show_status(f'Success Rate = {self.success_rate}%')
+        print(f'Final: Success Rate = {self.success_rate}%')
+
+    # Load the data and find good clusters.
+    def load_data(self):
+        # Only training needs the DataPoints, so they are made when
+        # they are first used. A saved model does not need them.
+        dataset = load_dataset(self.data_file, self.idx_images_file,
+            self.idx_labels_file, self.requested_rows, self.requested_cols)
+        self.num_rows = dataset.num_rows
+        self.num_cols = dataset.num_cols
+        self.data_points = dataset.data_points(DataPoint)
+        self.dataset = dataset
+
+    # Load the model saved by save_trained_model.
+    # Return False if there is no saved model for this data and params.
+    def load_trained_model(self, params):
+        model = load_model(MODEL_DIRECTORY, model_key(self.dataset, params))
+        if model is None:
+            return False
+
+        # naive_bayes looks up one value at a time, which is faster in lists.
+        self.cluster_names = model['cluster_names'].tolist()
+        self.fractions = model['fractions'].tolist()
+        self.means = model['means'].tolist()
+        self.std_devs = model['std_devs'].tolist()
+        self.success_rate = model['success_rate']
+        return True
+
+    # Save the cluster names, fractions, means, and std devs.
+    def save_trained_model(self, params):
+        arrays = {
+            'cluster_names': np.array(self.cluster_names),
+            'fractions': np.array(self.fractions, dtype=np.float64),
+            'means': np.array(self.means, dtype=np.float64),
+            'std_devs': np.array(self.std_devs, dtype=np.float64),
+        }
+        try:
+            save_model(MODEL_DIRECTORY, model_key(self.dataset, params), arrays,
+                {'success_rate': self.success_rate})
+        except OSError:
+            # We can still use the model if it cannot be saved.
+            pass
+
+    # Prepare for classification.
+    def classify(self):
+        # Separate the clusters.
+        self.cluster_dictionary = make_cluster_dictionary(self.data_points)
+
+        # Calculate mean and std dev for the x and y properties.
+        self.cluster_names, self.fractions, self.means, self.std_devs = \
+            summarize_points(len(self.data_points), self.cluster_dictionary)
+
+
+    def calculate_success_rate(self, data_points):
+        num_successes = 0
+
+        for data_point in data_points:
+            original_name = data_point.name
+            data_point.naive_bayes(self.cluster_names, self.fractions, self.means, self.std_devs)
+            if data_point.name == original_name:
+                num_successes += 1
+
+        self.success_rate = (num_successes / len(data_points)) * 100
+
+    # Add a labelled drawing to the model and save it in the data file's
+    # log so it is loaded next time. Each cluster keeps a running count
+    # of its points and the sum of their properties, so only the new
+    # point's cluster gets new means and std devs.
+    def add_sample(self, zeros_and_ones, name):
+        data_point = DataPoint(f'{name}: {zeros_and_ones}')
+        append_log(log_path(self.idx_images_file or self.data_file), name,
+            data_point.properties, self.num_rows, self.num_cols)
+        if self.cluster_counts is None:
+            self.count_clusters()
+        self.dataset.append(data_point.properties, name)
+        self.data_points.append(data_point)
+
+        # Find or make the point's cluster.
+        if name in self.cluster_names:
+            cluster_num = self.cluster_names.index(name)
+        else:
+            cluster_num = len(self.cluster_names)
+            self.cluster_names.append(name)
+            self.cluster_counts.append(0)
+            self.cluster_sums.append([0] * len(data_point.properties))
+            self.means.append(None)
+            self.std_devs.append(None)
+
+        # Update the cluster's counts and summarize it again.
+        # The properties are 0s and 1s, so the variance is mean - mean**2.
+        self.cluster_counts[cluster_num] += 1
+        sums = self.cluster_sums[cluster_num]
+        for property_num in range(len(sums)):
+            sums[property_num] += data_point.properties[property_num]
+        means = [total / self.cluster_counts[cluster_num] for total in sums]
+        self.means[cluster_num] = means
+        self.std_devs[cluster_num] = [max(math.sqrt(max(mean - mean * mean, 0)), MIN_STD_DEV) for mean in means]
+
+        # Every cluster's fraction changes.
+        num_points = sum(self.cluster_counts)
+        self.fractions = [count / num_points for count in self.cluster_counts]
+
+    # Count the points in each cluster and add up their properties.
+    def count_clusters(self):
+        labels = np.asarray(self.dataset.labels)
+        features = np.asarray(self.dataset.features)
+        self.cluster_counts = []
+        self.cluster_sums = []
+        for cluster_name in self.cluster_names:
+            in_cluster = labels == cluster_name
+            self.cluster_counts.append(int(in_cluster.sum()))
+            self.cluster_sums.append(features[in_cluster].sum(axis=0, dtype=np.int64).tolist())
+
+    # Give a DataPoint the name of its most likely cluster and return the name.
+    def classify_data_point(self, data_point):
+        data_point.naive_bayes(self.cluster_names, self.fractions, self.means, self.std_devs)
+        return data_point.name
+
+    # Return the name of the most likely cluster for a string of 0s and 1s.
+    def classify_pattern(self, zeros_and_ones):
+        return self.classify_data_point(DataPoint(f'?: {zeros_and_ones}'))
+
+    # Return an array holding the name of the most likely cluster for each
+    # row of 0s and 1s. The properties are 0s and 1s, so each property's
+    # probability is looked up in a table made with calculate_probability.
+    # The probabilities are multiplied in the same order as naive_bayes,
+    # so the results match classify_data_point exactly.
+    def classify_patterns(self, features):
+        features = np.asarray(features)
+        num_clusters = len(self.cluster_names)
+        num_properties = features.shape[1]
+        table = np.array([[[calculate_probability(x,
+            self.means[cluster_num][property_num], self.std_devs[cluster_num][property_num])
+            for property_num in range(num_properties)]
+            for cluster_num in range(num_clusters)] for x in (0, 1)])
+
+        probs = np.tile(np.array(self.fractions, dtype=np.float64), (len(features), 1))
+        clusters = np.arange(num_clusters)
+        for property_num in range(num_properties):
+            probs *= table[features[:, property_num, None], clusters[None, :], property_num]
+        return np.array(self.cluster_names)[np.argmax(probs, axis=1)]
+
+
+# In[ ]:
+
+
+# The main App class.
+class App(NaiveBayesDigits):
     # Create and manage the tkinter interface.
-    def __init__(self):
+    def __init__(self, retrain=False, **data_options):
+        NaiveBayesDigits.__init__(self, **data_options)
         self.network = None
 
+        # Import tkinter here so the rest of the module works without a display.
+        global tk
+        import tkinter as tk
+
         # Make the main interface.
         self.window = tk.Tk()
         self.window.title('naive_bayes_digits')
         self.window.protocol('WM_DELETE_WINDOW', self.kill_callback)
-        self.window.geometry(f'{WINDOW_WID}x{WINDOW_HGT}')
 
-        # Build the UI.
-        self.build_ui()
+        # Typing a digit adds the last drawing to the data with that name.
+        self.window.bind('<Key>', self.label_drawing)
 
-        # Load the data.
+        # Load the data. This tells us the size of the grid.
         self.load_data()
+        self.window.geometry(f'{self.num_cols * CELL_WID + 100}x{self.num_rows * CELL_HGT + 40}')
 
-        # Train for naive Bayes classification.
-        self.classify()
-
-        # Calculate the success rate.
-        self.calculate_success_rate(self.data_points)
+        # Build the UI.
+        self.build_ui()
 
-        # Display the final results.
-        self.success_rate_value.set(f'Success Rate = {self.success_rate}%')
-        print(f'Final: Success Rate = {self.success_rate}%')
+        # Train and display the success rate.
+        self.train(retrain)
 
         # Initially we have nothing to draw.
         self.polyline = None
         self.points = []
+        self.drawn_points = []
+        self.redraw_pending = None
+        self.last_pattern = None
 
         # Display the window.
         self.window.focus_force()
         self.window.mainloop()
 
-    # Load the data and find good clusters.
-    def load_data(self):
-        # Load the DataPoints.
-        with open('digit_data.txt', 'r') as f:
-            lines = f.readlines()
-            self.data_points = []
-            for line in lines:
-                self.data_points.append(DataPoint(line))
+    # Display a status message below the drawing.
+    def show_status(self, text):
+        self.success_rate_value.set(text)
 
+    # Draw the stroke's points. The polyline is made once per stroke,
+    # and after that its coordinates are updated in place.
     def redraw(self):
-        # Remove old polyline.
-        self.canvas.delete(self.polyline)
-        self.polyline = None
-
-        # Draw current points.
-        if len(self.points) > 1:
-            self.polyline = self.canvas.create_line(self.points, fill='black')
+        self.redraw_pending = None
+        if len(self.drawn_points) < 2:
+            return
+        if self.polyline is None:
+            self.polyline = self.canvas.create_line(self.drawn_points, fill='black')
+        else:
+            self.canvas.coords(self.polyline, self.drawn_points)
+
+    # Redraw at the next frame. Motion events that
+    # arrive before then are all drawn at once.
+    def schedule_redraw(self):
+        if self.redraw_pending is None:
+            self.redraw_pending = self.window.after(FRAME_MS, self.redraw)
+
+    # Draw any points that are waiting for the next frame now.
+    def flush_redraw(self):
+        if self.redraw_pending is not None:
+            self.window.after_cancel(self.redraw_pending)
+            self.redraw()
+
+    # Remove the stroke and forget its points.
+    def clear_drawing(self):
+        if self.redraw_pending is not None:
+            self.window.after_cancel(self.redraw_pending)
+            self.redraw_pending = None
+        if self.polyline is not None:
+            self.canvas.delete(self.polyline)
+            self.polyline = None
+        self.points = []
+        self.drawn_points = []
 
     def build_ui(self):
         # Make the drawing canvas.
-        canvas_wid = NUM_COLS * CELL_WID + 1
-        canvas_hgt = NUM_ROWS * CELL_HGT + 1
+        canvas_wid = self.num_cols * CELL_WID + 1
+        canvas_hgt = self.num_rows * CELL_HGT + 1
         self.canvas = tk.Canvas(self.window, bg='white',
             borderwidth=0, highlightthickness=0, relief=tk.SUNKEN, width=canvas_wid, height=canvas_hgt)
         self.canvas.place(x=MARGIN, y=MARGIN)
@@ -202,9 +430,9 @@ class App:
         self.canvas.bind('<ButtonRelease-1>', self.end_draw)
 
         # Make grid lines.
-        for r in range(NUM_ROWS + 1):
+        for r in range(self.num_rows + 1):
             self.canvas.create_line(0, r * CELL_HGT, canvas_wid, r * CELL_HGT, fill='lime')
-        for c in range(NUM_COLS + 1):
+        for c in range(self.num_cols + 1):
             self.canvas.create_line(c * CELL_WID, 0, c * CELL_WID, canvas_hgt, fill='lime')
 
         # Make a label to display success percentage.
@@ -222,20 +450,37 @@ class App:
         self.user_result_value.set('')
 
         # Remove any previous drawing.
-        self.points = []
-        self.redraw()
+        self.clear_drawing()
 
         self.canvas.bind('<B1-Motion>', self.save_point)
 
     def end_draw(self, event):
         self.canvas.unbind('<B1-Motion>')
+        self.flush_redraw()
 
         # Evaluate the polyline.
         self.evaluate_polyline()
 
     def save_point(self, event):
         self.points.append((event.x, event.y))
-        self.redraw()
+
+        # Draw the point if it is far enough from the last one drawn.
+        if len(self.drawn_points) == 0 or \
+            (event.x - self.drawn_points[-1][0]) ** 2 + \
+            (event.y - self.drawn_points[-1][1]) ** 2 >= MIN_DRAW_DISTANCE ** 2:
+            self.drawn_points.append((event.x, event.y))
+            self.schedule_redraw()
+
+    # The user has typed a key. If it is a digit, add the
+    # last drawing to the data with that digit as its name.
+    def label_drawing(self, event):
+        if len(event.char) != 1 or event.char not in '0123456789' or self.last_pattern is None:
+            return
+
+        self.add_sample(self.last_pattern, event.char)
+        self.last_pattern = None
+        self.success_rate_value.set(f'Added a {event.char}, {len(self.data_points)} digits')
+        print(f'Added: {event.char}')
 
     def kill_callback(self):
         self.window.destroy()
@@ -246,8 +491,7 @@ class App:
         data_point = self.polyline_to_data_point()
 
         # Give the point a cluster name.
-        data_point.naive_bayes(self.cluster_names,
-            self.fractions, self.means, self.std_devs)
+        self.classify_data_point(data_point)
 
         # Display the result.
         self.user_result_value.set(data_point.name)
@@ -261,6 +505,9 @@ class App:
         # Convert the touched cells to a string.
         touched_string = self.touched_to_string(touched)
 
+        # Remember the pattern so the user can label it.
+        self.last_pattern = touched_string
+
         # Compose the DataPoint data string.
         data_string = f'?: {touched_string}'
 
@@ -271,14 +518,14 @@ class App:
     def get_touched(self):
         # Make a touched array holding 0s.
         touched = []
-        for r in range(NUM_ROWS):
-            touched.append([0 for i in range(NUM_COLS)])
+        for r in range(self.num_rows):
+            touched.append([0 for i in range(self.num_cols)])
 
         # Mark the touched cells.
         for point in self.points:
             r = int(point[1] / CELL_HGT)
             c = int(point[0] / CELL_WID)
-            if r >= 0 and r < NUM_ROWS and c >= 0 and c < NUM_COLS:
+            if r >= 0 and r < self.num_rows and c >= 0 and c < self.num_cols:
                 touched[r][c] = 1
 
         # Return the touched list.
@@ -287,37 +534,55 @@ class App:
     # Return a string holding the touch values.
     def touched_to_string(self, touched):
         result = ''
-        for r in range(NUM_ROWS):
-            for c in range(NUM_COLS):
+        for r in range(self.num_rows):
+            for c in range(self.num_cols):
                 result += str(touched[r][c])
         return result
 
-    # Prepare for classification.
-    def classify(self):
-        # Separate the clusters.
-        self.cluster_dictionary = make_cluster_dictionary(self.data_points)
-
-        # Calculate mean and std dev for the x and y properties.
-        self.cluster_names, self.fractions, self.means, self.std_devs = \
-            summarize_points(len(self.data_points), self.cluster_dictionary)
-
-
-    def calculate_success_rate(self, data_points):
-        num_successes = 0
-
-        for data_point in data_points:
-            original_name = data_point.name
-            data_point.naive_bayes(self.cluster_names, self.fractions, self.means, self.std_devs)
-            if data_point.name == original_name:
-                num_successes += 1
-
-        self.success_rate = (num_successes / len(data_points)) * 100
-
 
 # In[61]:
 
 
-App()
+# Run the App, or with --headless, just train and print the results.
+def main():
+    parser = argparse.ArgumentParser(description='Use naive Bayes to classify drawn digits.')
+    add_data_arguments(parser, DATA_FILE, NUM_ROWS, NUM_COLS)
+    parser.add_argument('--headless', action='store_true',
+        help='train and print the results without opening a window')
+    parser.add_argument('--retrain', action='store_true',
+        help=f'train even if {MODEL_DIRECTORY} holds a model for this data')
+    parser.add_argument('--classify', nargs='+', default=[], metavar='PATTERN',
+        help='strings of 0s and 1s to classify after training (with --headless)')
+    parser.add_argument('--add', nargs='+', default=[], metavar='DIGIT:PATTERN',
+        help='labelled drawings to add to the data before classifying (with --headless)')
+    args = parser.parse_args()
+
+    if not args.headless:
+        App(args.retrain, **data_options(args))
+        return
+
+    naive_bayes_digits = NaiveBayesDigits(**data_options(args))
+    start_time = time.perf_counter()
+    naive_bayes_digits.load_data()
+    print(f'Loaded {len(naive_bayes_digits.data_points)} digits in {time.perf_counter() - start_time:.3f} seconds')
+
+    start_time = time.perf_counter()
+    naive_bayes_digits.train(args.retrain)
+    print(f'Trained in {time.perf_counter() - start_time:.3f} seconds')
+
+    for sample in args.add:
+        name, pattern = sample.split(':')
+        naive_bayes_digits.add_sample(pattern, name)
+        print(f'Added {name}: {pattern}')
+
+    for pattern in args.classify:
+        start_time = time.perf_counter()
+        name = naive_bayes_digits.classify_pattern(pattern)
+        print(f'{pattern}: {name} ({1000 * (time.perf_counter() - start_time):.3f} ms)')
+
+
+if __name__ == '__main__':
+    main()
 
 
 # In[ ]: